@@ -0,0 +1,70 @@
+"""startup_benchmark.py
+Measures how long the script takes to start: how long importing each command's modules takes, and how long the
+status command takes from start to finish.
+Run it from the directory that you run the script from (it uses the seen files and journal there):
+python3 benchmarks/startup_benchmark.py"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules to measure the import time of: the command line interface and what each command imports
+MODULES = ["main", "journal", "runner", "planner"]
+
+def get_import_time(module_name:str)->Optional[float]:
+    """Measures how long it takes to import a module in a new interpreter, using python -X importtime.
+
+    :param module_name: The module to import.
+
+    :returns The import time in milliseconds, or None if the module could not be imported (for example because a
+    library is not installed)."""
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module_name}"], capture_output=True, text=True,
+                             env=dict(os.environ, PYTHONPATH=REPOSITORY_DIR))
+    if process.returncode != 0:
+        return None
+    # Lines look like "import time: <self us> | <cumulative us> | <module>", and the imported module comes last
+    for line in reversed(process.stderr.splitlines()):
+        self_time, cumulative_time, imported_module = line.split("|")
+        if imported_module.strip() == module_name:
+            return int(cumulative_time) / 1000
+    return None
+
+def get_command_times(command:List[str], runs:int)->List[float]:
+    """Measures how long a command of the script takes, from starting the interpreter until it exits.
+
+    :param command: The arguments to pass to main.py.
+
+    :param runs: How many times to run the command.
+
+    :returns The time of each run in milliseconds."""
+    command_times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(REPOSITORY_DIR, "main.py")] + command, capture_output=True, check=True)
+        command_times.append((time.perf_counter() - start_time) * 1000)
+    return command_times
+
+def main()->None:
+    argument_parser = argparse.ArgumentParser(description="Measures the startup time of the script.")
+    argument_parser.add_argument("--runs", type=int, default=10, help="How many times to run the status command.")
+    arguments = argument_parser.parse_args()
+    print("Import times (cumulative, in a new interpreter):")
+    for module_name in MODULES:
+        import_time = get_import_time(module_name)
+        print(f"  {module_name}: " + (f"{import_time:.1f} ms" if import_time is not None else "could not be imported"))
+    interpreter_times = []
+    for _ in range(arguments.runs):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        interpreter_times.append((time.perf_counter() - start_time) * 1000)
+    status_times = get_command_times(["status"], arguments.runs)
+    print(f"Starting the interpreter: median {statistics.median(interpreter_times):.1f} ms")
+    print(f"main.py status: median {statistics.median(status_times):.1f} ms, min {min(status_times):.1f} ms, "
+          f"max {max(status_times):.1f} ms ({arguments.runs} runs)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""concurrency.py
+Limits how many requests are sent to an API at the same time, adapting the limit to how the API is doing instead of
+having to tune it by hand. The limit is adjusted like TCP congestion control (AIMD): it is increased a little for
+every request that succeeds, and halved when the API is overloaded, that is when it responds with a rate limit or
+server error, or when requests take a lot longer than they usually do.
+Different types of requests (for example listing files and downloading them) take very different amounts of time, so
+each request type is compared to its own usual latency."""
+import threading
+import time
+from typing import Dict
+
+DEFAULT_INITIAL_LIMIT = 4
+DEFAULT_MAX_LIMIT = 16
+
+class AdaptiveConcurrencyLimiter:
+    def __init__(self, name:str, initial_limit:float=DEFAULT_INITIAL_LIMIT, min_limit:float=1, max_limit:float=DEFAULT_MAX_LIMIT,
+                 backoff_factor:float=0.5, latency_tolerance:float=2.0, latency_smoothing:float=0.2):
+        """Initializes an adaptive concurrency limiter. It is thread-safe, so it can be shared between clients and threads.
+
+        :param name: The name of the limiter. Used in metrics.
+
+        :param initial_limit: How many requests to allow in flight at first.
+
+        :param min_limit: The lowest the limit can go.
+
+        :param max_limit: The highest the limit can go.
+
+        :param backoff_factor: What to multiply the limit with when the API is overloaded.
+
+        :param latency_tolerance: How many times longer than usual requests of a type may take before the API is
+        considered overloaded.
+
+        :param latency_smoothing: How much weight each request has in the average latency of its type (between 0 and 1)."""
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_factor = backoff_factor
+        self.latency_tolerance = latency_tolerance
+        self.latency_smoothing = latency_smoothing
+        self.in_flight = 0
+        # By request type: exponentially weighted moving averages of the latency in seconds, and what the latency
+        # usually is when the API is not overloaded
+        self.average_latencies:Dict[str,float] = {}
+        self.baseline_latencies:Dict[str,float] = {}
+        self.last_backoff = 0.0
+        self.number_of_requests = self.number_of_overloaded_requests = self.number_of_backoffs = 0
+        self.condition = threading.Condition()
+
+    def acquire(self)->float:
+        """Waits until another request may be sent. Every call must be followed by a call to release().
+
+        :returns The time the request was started at, to pass to release()."""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, start_time:float, overloaded:bool=False, request_type:str="default")->None:
+        """Marks a request as completed and adjusts the limit.
+
+        :param start_time: The time returned by acquire().
+
+        :param overloaded: True if the API responded with a rate limit or server error, or if the request failed.
+
+        :param request_type: What kind of request it was, for example the API method. The latency of the request is
+        only compared to that of other requests of the same type."""
+        now = time.monotonic()
+        latency = now - start_time
+        with self.condition:
+            self.in_flight -= 1
+            self.number_of_requests += 1
+            if overloaded:
+                self.number_of_overloaded_requests += 1
+            else:
+                self.update_latency(request_type, latency)
+                overloaded = self.average_latencies[request_type] > self.baseline_latencies[request_type] * self.latency_tolerance
+            if overloaded:
+                # Requests that were sent at the same time will likely all fail, so only back off once per round trip
+                if now - self.last_backoff > self.average_latencies.get(request_type, 0):
+                    self.limit = max(self.min_limit, self.limit * self.backoff_factor)
+                    self.last_backoff = now
+                    self.number_of_backoffs += 1
+            else:
+                # Increase by about one for every limit's worth of successful requests
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def update_latency(self, request_type:str, latency:float)->None:
+        """Updates the average latency of a request type and the baseline it is compared to. Must be called with the
+        condition held.
+
+        :param request_type: The type of the request, see release().
+
+        :param latency: The latency of a successful request in seconds."""
+        if request_type not in self.average_latencies:
+            self.average_latencies[request_type] = self.baseline_latencies[request_type] = latency
+            return
+        average_latency = self.average_latencies[request_type] + (latency - self.average_latencies[request_type]) * self.latency_smoothing
+        baseline_latency = self.baseline_latencies[request_type]
+        if average_latency < baseline_latency:
+            baseline_latency = average_latency
+        else: # (drift upwards slowly, so that a lasting change in latency becomes the new normal)
+            baseline_latency += (average_latency - baseline_latency) * self.latency_smoothing / 10
+        self.average_latencies[request_type] = average_latency
+        self.baseline_latencies[request_type] = baseline_latency
+
+    def get_metrics(self)->dict:
+        """Gets the current state of the limiter.
+
+        :returns A dict with the current limit and statistics about the requests so far."""
+        with self.condition:
+            return {
+                "name": self.name,
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "latency_ms": {request_type: {"average": round(average_latency * 1000),
+                                              "baseline": round(self.baseline_latencies[request_type] * 1000)}
+                               for request_type, average_latency in self.average_latencies.items()},
+                "requests": self.number_of_requests,
+                "overloaded_requests": self.number_of_overloaded_requests,
+                "backoffs": self.number_of_backoffs
+            }
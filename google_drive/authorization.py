@@ -1,39 +1,70 @@
 """authorization.py
 This file ensures that the Google Drive API is correctly authenticated.
-If it isn't, it starts a live server."""
+If it isn't, it starts a live server.
+The configuration is read when it is needed rather than when this file is imported."""
 from utilities import get_logger, get_config, WORKING_DIR
+from concurrency import AdaptiveConcurrencyLimiter
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build, Resource
+from googleapiclient.http import HttpRequest
 from googleapiclient.errors import HttpError
+from datetime import datetime, timezone
+import threading
+from typing import List, Optional
 import os.path
 logger = get_logger(__name__)
-# Load parameters from config file
-GOOGLE_DRIVE_CONFIG = get_config()["google_drive"]
-GOOGLE_SCOPES = GOOGLE_DRIVE_CONFIG["scopes"]
-CREDENTIALS_FILE = os.path.join(WORKING_DIR, GOOGLE_DRIVE_CONFIG["credentials_file"])
-TOKEN_FILE = os.path.join(WORKING_DIR, GOOGLE_DRIVE_CONFIG["token_file"])
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+# The fields needed when listing files: checksums and versions are used for verifying and caching downloads
+DEFAULT_FILE_LIST_FIELDS = "nextPageToken, files(id, name, md5Checksum, version)"
+
+def format_drive_time(time:datetime)->str:
+    """Formats a time in the RFC 3339 format that Google Drive queries use. Times without a timezone are
+    assumed to be in local time."""
+    return time.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def get_default_token_file()->str:
+    """Gets the path to the token file set under google_drive in the configuration."""
+    return os.path.join(WORKING_DIR, get_config()["google_drive"]["token_file"])
+
+def is_overloaded_error(error:HttpError)->bool:
+    """Checks if an error from Google Drive means that it is overloaded: a rate limit or a server error.
+    Google Drive reports some rate limits with the status code 403 instead of 429."""
+    status_code = int(error.resp.status)
+    return status_code == 429 or status_code >= 500 or (status_code == 403 and b"ateLimitExceeded" in error.content)
 
 class DriveAPIHandler():
-    def __init__(self):
+    def __init__(self, token_file:Optional[str]=None, concurrency_limiter:Optional[AdaptiveConcurrencyLimiter]=None):
+        """Initializes a Google Drive API handler.
+
+        :param token_file: The file to store the token for the Google account in. Use different files to access
+        different accounts. Defaults to the token file in the configuration.
+
+        :param concurrency_limiter: A limiter for how many requests may be in flight at once, which backs off when
+        Google Drive is overloaded. If not set, a new limiter is created."""
+        self.token_file = token_file if token_file is not None else get_default_token_file()
+        self.concurrency_limiter = concurrency_limiter if concurrency_limiter is not None else AdaptiveConcurrencyLimiter("google_drive")
         self.api_client = self.credentials = self.token = None
+        self.thread_local = threading.local()
     def authorize(self) -> Resource:
         """Main function for ensuring that the user is authenticated with Google Drive.
         If not, it handles the authentication."""
+        google_drive_config = get_config()["google_drive"]
+        google_scopes = google_drive_config["scopes"]
         # Check if files exist
-        if not os.path.exists(TOKEN_FILE):
+        if not os.path.exists(self.token_file):
             logger.info("Token file does not exist. Starting configuration flow...")
+            from google_auth_oauthlib.flow import InstalledAppFlow # (only needed the first time, so imported here)
             # Start the configuration flow
-            flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, GOOGLE_SCOPES)
+            flow = InstalledAppFlow.from_client_secrets_file(os.path.join(WORKING_DIR, google_drive_config["credentials_file"]), google_scopes)
             self.credentials = flow.run_local_server(port=80)
             logger.info("Configuration flow completed. Saving...")
-            with open(TOKEN_FILE, "w") as token_file:
+            with open(self.token_file, "w") as token_file:
                 token_file.write(self.credentials.to_json())
         else:
             logger.info("Credentials exist!")
         # Load credentials from file
-        self.credentials = Credentials.from_authorized_user_file(TOKEN_FILE, GOOGLE_SCOPES)
+        self.credentials = Credentials.from_authorized_user_file(self.token_file, google_scopes)
         # Check if they need to be refreshed
         if not self.credentials.valid:
             # If they expired, validate that we have a refresh token.
@@ -42,34 +73,92 @@ class DriveAPIHandler():
                 self.credentials.refresh(Request())
                 logger.info("Credentials refreshed.")
             else: # (This is not expeted)
-                logger.critical(f"Missing refresh token for expired credentials. Try deleting the file {TOKEN_FILE} and trying again.")
+                logger.critical(f"Missing refresh token for expired credentials. Try deleting the file {self.token_file} and trying again.")
         else:
             logger.info("Credentials OK: No need to re-retrieve anything.")
         logger.info("Returning API client...")
         self.api_client = build("drive", "v3", credentials=self.credentials) # Create client from scopes
         return self.api_client
 
-    def list_all_files_in_directory(self, directory_id, fields="nextPageToken, files(id, name,mimeType)", next_page_token=None, previous_files=[]):
+    def for_current_thread(self)->"DriveAPIHandler":
+        """Gets a handler that can be used from the current thread. The API client is not thread-safe, so each
+        thread that uses the API at the same time needs its own client. Must be called after authorize().
+
+        :returns A handler with the same credentials, but with an API client for the current thread."""
+        if not hasattr(self.thread_local, "handler"):
+            handler = DriveAPIHandler(self.token_file, self.concurrency_limiter) # (the limit is shared between all threads)
+            handler.credentials = self.credentials
+            handler.api_client = build("drive", "v3", credentials=self.credentials)
+            self.thread_local.handler = handler
+        return self.thread_local.handler
+
+    def execute(self, request:HttpRequest)->dict:
+        """Executes a Google Drive API request, waiting if too many requests are in flight already.
+
+        :param request: The request to execute, for example api_client.files().list(...).
+
+        :returns The response."""
+        request_start_time = self.concurrency_limiter.acquire()
+        overloaded = False
+        try:
+            return request.execute()
+        except HttpError as e:
+            overloaded = is_overloaded_error(e)
+            raise
+        except (IOError, ConnectionError):
+            overloaded = True
+            raise
+        finally:
+            self.concurrency_limiter.release(request_start_time, overloaded, request.methodId) # (for example drive.files.list)
+
+    def get_files_query(self, directory_id:str, mime_types:Optional[List[str]]=None, include_trashed:bool=False,
+                        include_folders:bool=True, modified_after:Optional[datetime]=None, modified_before:Optional[datetime]=None)->str:
+        """Builds a Google Drive search query for listing files, so that filtering is done by Google Drive rather than here.
+
+        See list_all_files_in_directory() for the parameters."""
+        query_parts = [f"'{directory_id}' in parents"]
+        if not include_trashed:
+            query_parts.append("trashed = false")
+        if mime_types is not None:
+            query_parts.append("(" + " or ".join(f"mimeType = '{mime_type}'" for mime_type in mime_types) + ")")
+        if not include_folders:
+            query_parts.append(f"mimeType != '{FOLDER_MIME_TYPE}'")
+        if modified_after is not None:
+            query_parts.append(f"modifiedTime > '{format_drive_time(modified_after)}'")
+        if modified_before is not None:
+            query_parts.append(f"modifiedTime < '{format_drive_time(modified_before)}'")
+        return " and ".join(query_parts)
+
+    def list_all_files_in_directory(self, directory_id:str, fields:str=DEFAULT_FILE_LIST_FIELDS, mime_types:Optional[List[str]]=None,
+                                    include_trashed:bool=False, include_folders:bool=True, modified_after:Optional[datetime]=None,
+                                    modified_before:Optional[datetime]=None)->List[dict]:
+        """Lists all files in a directory, fetching every page of results.
+
+        :param directory_id: The ID of the directory on Google Drive.
+
+        :param fields: Which fields to retrieve. Keep this minimal to keep responses small.
+
+        :param mime_types: If set, only list files with one of these MIME types.
+
+        :param include_trashed: If True, also list files that are in the trash.
+
+        :param include_folders: If False, do not list subfolders.
+
+        :param modified_after: If set, only list files modified after this time.
+
+        :param modified_before: If set, only list files modified before this time.
+
+        :returns A list of file objects as returned by the Google API."""
         list_files_kwargs = {
-            "pageSize": 100,
+            "pageSize": 1000, # (the maximum, to need as few requests as possible)
             "fields": fields,
-            "q": f"'{directory_id}' in parents"
+            "q": self.get_files_query(directory_id, mime_types, include_trashed, include_folders, modified_after, modified_before)
         }
-        if next_page_token is not None:
-            list_files_kwargs["pageToken"] = next_page_token
-        if previous_files is None:
-            previous_files = []
-        response = self.api_client.files().list(**list_files_kwargs).execute()
-        # Check for response
-        if "files" in response:
-            previous_files.extend(response["files"])
-            if "nextPageToken" in response: # Multiple files: apply recursion
-                return self.list_all_files_in_directory(
-                    directory_id,
-                    fields=fields,
-                    next_page_token=response["nextPageToken"],
-                    previous_files=previous_files
-                )
-            return previous_files
-        return []
-
+        logger.debug(f"Listing files with query {list_files_kwargs['q']}...")
+        files = []
+        while True:
+            response = self.execute(self.api_client.files().list(**list_files_kwargs))
+            files.extend(response.get("files", []))
+            if "nextPageToken" not in response: # No more pages
+                return files
+            list_files_kwargs["pageToken"] = response["nextPageToken"]
@@ -0,0 +1,185 @@
+"""downloads.py
+Streams files from Google Drive to disk.
+Downloads are written in chunks to a partial file which is fsync'd and atomically renamed into place once complete,
+and verified against the MD5 checksum that Google Drive reports for the file.
+If a download is interrupted, the partial file is kept so that the next attempt can resume it using a Range request.
+Optionally, downloads go through a FileCache so that files that have been downloaded before are not downloaded again."""
+import hashlib
+import os
+import time
+from typing import Optional
+from google.auth.transport.requests import AuthorizedSession
+from utilities import get_logger, fsync_directory
+from concurrency import AdaptiveConcurrencyLimiter
+from .file_cache import FileCache
+
+logger = get_logger(__name__)
+
+DRIVE_DOWNLOAD_URL = "https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024 # 8 MiB
+DEFAULT_MAX_RETRIES = 5
+PARTIAL_FILE_SUFFIX = ".part"
+
+class DownloadFailed(Exception):
+    pass
+
+class ChecksumMismatch(DownloadFailed):
+    pass
+
+class TransientDownloadError(DownloadFailed):
+    def __init__(self, message:str, retry_after:Optional[float]=None):
+        """Raised when Google Drive responds with a rate limit or server error. The download can be retried.
+
+        :param message: What went wrong.
+
+        :param retry_after: If Google Drive said how long to wait before retrying, the number of seconds."""
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class DriveFileDownloader:
+    def __init__(self, credentials, target_directory:str, chunk_size:int=DEFAULT_CHUNK_SIZE, max_retries:int=DEFAULT_MAX_RETRIES, cache:Optional[FileCache]=None,
+                 concurrency_limiter:Optional[AdaptiveConcurrencyLimiter]=None):
+        """Initializes a downloader for Google Drive files.
+
+        :param credentials: Google credentials to authorize requests with. See DriveAPIHandler.authorize().
+
+        :param target_directory: The directory to put downloaded files in.
+
+        :param chunk_size: How many bytes to read from the network and write to disk at a time.
+
+        :param max_retries: How many times to retry (resume) a download that was interrupted.
+
+        :param cache: If set, a file cache to look up files in before downloading them and to add downloaded files to.
+
+        :param concurrency_limiter: If set, a limiter for how many requests to Google Drive may be in flight at once.
+        Pass the limiter of the DriveAPIHandler to share it with other requests to the same account."""
+        self.credentials = credentials
+        self.target_directory = target_directory
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.cache = cache
+        self.concurrency_limiter = concurrency_limiter
+        self.session = AuthorizedSession(self.credentials)
+
+    def get_target_path(self, file_object:dict)->str:
+        """Gets the path that a file will be downloaded to.
+        The path is derived from the file ID so that an interrupted download can be found and resumed later.
+
+        :param file_object: Data for the file as a response dict returned by the Google API."""
+        file_extension = os.path.splitext(file_object["name"])[1]
+        return os.path.join(self.target_directory, f"{file_object['id']}{file_extension}")
+
+    def download(self, file_object:dict)->str:
+        """Downloads a file from Google Drive.
+
+        :param file_object: Data for the file as a response dict returned by the Google API.
+        If it includes the md5Checksum key, the downloaded file is verified against it.
+
+        :returns The path that the file was downloaded to. If a cache is used, this is a path in the cache."""
+        file_id = file_object["id"]
+        if self.cache is not None:
+            cached_path = self.cache.get(file_object)
+            if cached_path is not None:
+                return cached_path
+        expected_checksum = file_object.get("md5Checksum", None)
+        target_path = self.get_target_path(file_object)
+        partial_path = target_path + PARTIAL_FILE_SUFFIX
+        retries = 0
+        restarted_after_checksum_mismatch = False
+        while True:
+            try:
+                checksum = self.download_to_partial_file(file_id, partial_path)
+            except (IOError, ConnectionError, TransientDownloadError) as e:
+                # The partial file is kept, so that the next attempt resumes where this one stopped
+                retries += 1
+                if retries > self.max_retries:
+                    raise DownloadFailed(f"Download of file {file_id} failed after {self.max_retries} retries: {e}") from e
+                retry_after = getattr(e, "retry_after", None)
+                logger.warning(f"Download of file {file_id} was interrupted ({e}). Resuming (attempt {retries}/{self.max_retries})...")
+                time.sleep(retry_after if retry_after is not None else min(2 ** retries, 30))
+                continue
+            if expected_checksum is None or checksum == expected_checksum:
+                break
+            # The partial file can not be trusted, so start over from scratch (once)
+            os.remove(partial_path)
+            if restarted_after_checksum_mismatch:
+                raise ChecksumMismatch(f"Checksum mismatch for file {file_id}: expected {expected_checksum}, got {checksum}.")
+            logger.warning(f"Checksum mismatch for file {file_id}: expected {expected_checksum}, got {checksum}. Downloading it again...")
+            restarted_after_checksum_mismatch = True
+        os.replace(partial_path, target_path) # Atomically move the file into place
+        fsync_directory(self.target_directory)
+        logger.info(f"File {file_id} downloaded to {target_path}.")
+        if self.cache is not None:
+            target_path = self.cache.put(file_object, target_path)
+        return target_path
+
+    def send_download_request(self, file_id:str, request_headers:dict):
+        """Sends the request for the contents of a file. The request counts as in flight until the response headers
+        have been received: the time it takes to stream the contents depends on the size of the file, not on how busy
+        Google Drive is.
+
+        :param file_id: The ID of the file on Google Drive.
+
+        :param request_headers: Headers to send with the request.
+
+        :returns The (streamed) response."""
+        if self.concurrency_limiter is None:
+            return self.session.get(DRIVE_DOWNLOAD_URL.format(file_id=file_id), headers=request_headers, stream=True)
+        request_start_time = self.concurrency_limiter.acquire()
+        try:
+            response = self.session.get(DRIVE_DOWNLOAD_URL.format(file_id=file_id), headers=request_headers, stream=True)
+        except Exception:
+            self.concurrency_limiter.release(request_start_time, overloaded=True, request_type="download")
+            raise
+        self.concurrency_limiter.release(request_start_time, overloaded=response.status_code == 429 or response.status_code >= 500,
+                                         request_type="download")
+        return response
+
+    def download_to_partial_file(self, file_id:str, partial_path:str)->str:
+        """Downloads (or resumes downloading) a file to a partial file.
+
+        :param file_id: The ID of the file on Google Drive.
+
+        :param partial_path: The path of the partial file to write to.
+
+        :returns The MD5 checksum of the full partial file."""
+        checksum = hashlib.md5()
+        request_headers = {}
+        # Resume from any existing partial file
+        existing_size = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        if existing_size > 0:
+            logger.info(f"Found partial download of {existing_size} bytes for file {file_id}. Resuming...")
+            request_headers["Range"] = f"bytes={existing_size}-"
+        with self.send_download_request(file_id, request_headers) as response:
+            if response.status_code == 416: # Range not satisfiable: the partial file is already complete
+                logger.debug(f"Partial download for file {file_id} is already complete.")
+                file_mode = "rb+"
+            elif response.status_code == 206:
+                file_mode = "rb+"
+            elif response.status_code == 200: # Server ignored the range: start over
+                file_mode = "wb"
+            elif response.status_code == 429 or response.status_code >= 500:
+                retry_after = response.headers.get("Retry-After", None)
+                raise TransientDownloadError(f"Google Drive responded with status code {response.status_code} when downloading {file_id}",
+                                             float(retry_after) if retry_after is not None and retry_after.isdigit() else None)
+            else:
+                raise DownloadFailed(f"Unexpected status code received from Google Drive when downloading {file_id}: {response.status_code}.")
+            with open(partial_path, file_mode) as partial_file:
+                # Hash what we already have before appending to it
+                if file_mode == "rb+":
+                    for chunk in iter(lambda: partial_file.read(self.chunk_size), b""):
+                        checksum.update(chunk)
+                if response.status_code != 416:
+                    total_size = existing_size if file_mode == "rb+" else 0
+                    last_logged_progress = 0
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        partial_file.write(chunk)
+                        checksum.update(chunk)
+                        total_size += len(chunk)
+                        # Log progress every 100 MiB rather than for every chunk
+                        if total_size - last_logged_progress >= 100 * 1024 * 1024:
+                            logger.debug(f"Downloading file {file_id}... {total_size} bytes received.")
+                            last_logged_progress = total_size
+                partial_file.flush()
+                os.fsync(partial_file.fileno())
+        return checksum.hexdigest()
@@ -0,0 +1,104 @@
+"""file_cache.py
+A content-addressed cache for files downloaded from Google Drive.
+Files are keyed by the MD5 checksum that Google Drive reports for them (or by their ID and version if no checksum
+is available), so that the same bytes never have to be downloaded twice.
+The cache has a size cap, and the least recently used files are evicted when it is exceeded."""
+import os
+import shutil
+from typing import Optional
+from utilities import get_logger
+
+logger = get_logger(__name__)
+
+class FileCache:
+    def __init__(self, directory:str, max_size_bytes:int):
+        """Initializes a file cache.
+
+        :param directory: The directory to store cached files in. Created if it does not exist.
+
+        :param max_size_bytes: The maximum total size of the cache. Least recently used files are evicted
+        when calling evict() if the cache is larger than this."""
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+        if not os.path.exists(self.directory):
+            logger.info("Creating directory for the file cache...")
+            os.makedirs(self.directory)
+
+    def get_key(self, file_object:dict)->Optional[str]:
+        """Gets the cache key of a file.
+
+        :param file_object: Data for the file as a response dict returned by the Google API.
+
+        :returns The cache key, or None if the file does not have enough metadata to be cached."""
+        if "md5Checksum" in file_object:
+            return file_object["md5Checksum"]
+        elif "version" in file_object:
+            return f"{file_object['id']}-{file_object['version']}"
+        return None
+
+    def get_path(self, file_object:dict)->Optional[str]:
+        """Gets the path that a file is (or would be) stored at in the cache.
+
+        :param file_object: Data for the file as a response dict returned by the Google API.
+
+        :returns The path, or None if the file can not be cached."""
+        key = self.get_key(file_object)
+        if key is None:
+            return None
+        file_extension = os.path.splitext(file_object["name"])[1]
+        return os.path.join(self.directory, f"{key}{file_extension}")
+
+    def get(self, file_object:dict)->Optional[str]:
+        """Looks up a file in the cache.
+
+        :param file_object: Data for the file as a response dict returned by the Google API.
+
+        :returns The path to the cached file if it is in the cache, otherwise None."""
+        cache_path = self.get_path(file_object)
+        if cache_path is None or not os.path.exists(cache_path):
+            logger.debug(f"Cache miss for file {file_object['id']}.")
+            return None
+        logger.info(f"Cache hit for file {file_object['id']}: {cache_path}.")
+        os.utime(cache_path) # Mark the file as recently used
+        return cache_path
+
+    def put(self, file_object:dict, path:str)->str:
+        """Adds a downloaded file to the cache by moving it into the cache directory.
+
+        :param file_object: Data for the file as a response dict returned by the Google API.
+
+        :param path: The path of the downloaded file.
+
+        :returns The path to the file in the cache, or the original path if the file can not be cached."""
+        cache_path = self.get_path(file_object)
+        if cache_path is None:
+            logger.debug(f"File {file_object['id']} does not have a checksum or version and will not be cached.")
+            return path
+        shutil.move(path, cache_path)
+        logger.debug(f"File {file_object['id']} added to the cache at {cache_path}.")
+        return cache_path
+
+    def evict(self)->int:
+        """Removes the least recently used files from the cache until it is below its size cap.
+
+        :returns The number of files that were evicted."""
+        cached_files = []
+        total_size = 0
+        for filename in os.listdir(self.directory):
+            cache_path = os.path.join(self.directory, filename)
+            if not os.path.isfile(cache_path):
+                continue
+            file_stat = os.stat(cache_path)
+            cached_files.append((file_stat.st_mtime, file_stat.st_size, cache_path))
+            total_size += file_stat.st_size
+        cached_files.sort() # Least recently used first
+        files_evicted = 0
+        for _, file_size, cache_path in cached_files:
+            if total_size <= self.max_size_bytes:
+                break
+            os.remove(cache_path)
+            total_size -= file_size
+            files_evicted += 1
+        if files_evicted > 0:
+            logger.info(f"Evicted {files_evicted} files from the file cache.")
+        return files_evicted
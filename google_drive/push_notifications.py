@@ -0,0 +1,173 @@
+"""push_notifications.py
+Lets Google Drive notify the script when something changes, instead of only polling it every now and then.
+A DriveChangeWatcher registers a watch channel for the changes of a Google account, which makes Google Drive send
+notifications to an HTTPS address. That address should forward to the NotificationReceiver, a small local HTTP server.
+Channels expire, so they are renewed before they do.
+A channel covers every change in the Google account, so after a notification the changes are listed to check whether any
+of them are in a folder that the script syncs.
+
+To test the receiver locally, post a fake notification to it:
+curl -X POST -H "X-Goog-Resource-State: change" -H "X-Goog-Channel-Token: <token>" http://localhost:8080/"""
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Set
+from googleapiclient.errors import HttpError
+from utilities import get_logger
+from .authorization import DriveAPIHandler
+
+logger = get_logger(__name__)
+
+# Only the parents of changed files are needed to tell whether a change is relevant
+CHANGE_LIST_FIELDS = "newStartPageToken, nextPageToken, changes(fileId, removed, file(parents))"
+
+class DriveChangeWatcher:
+    def __init__(self, drive:DriveAPIHandler, address:str, token:Optional[str]=None, channel_ttl_seconds:float=86400):
+        """Initializes a watcher for changes in a Google account.
+
+        :param drive: An authorized Google Drive API handler for the account.
+
+        :param address: The public HTTPS address that Google Drive should send notifications to.
+
+        :param token: If set (and not empty), a secret that is included in every notification, to verify that they come from Google Drive.
+
+        :param channel_ttl_seconds: How long a channel should be valid for before it has to be renewed."""
+        self.drive = drive
+        self.address = address
+        self.token = token or None # (an empty token, as in the example configuration, means no token)
+        self.channel_ttl_seconds = channel_ttl_seconds
+        self.channel_id = self.resource_id = None
+        self.expires_at = 0.0
+        self.page_token:Optional[str] = None # (where to continue listing changes from)
+
+    def start(self)->None:
+        """Registers a new watch channel."""
+        if self.page_token is None: # (when renewing, keep the token so that no changes are skipped)
+            self.page_token = self.drive.execute(self.drive.api_client.changes().getStartPageToken())["startPageToken"]
+        channel_body = {
+            "id": str(uuid.uuid4()),
+            "type": "web_hook",
+            "address": self.address,
+            "expiration": int((time.time() + self.channel_ttl_seconds) * 1000) # (in milliseconds)
+        }
+        if self.token is not None:
+            channel_body["token"] = self.token
+        logger.info(f"Registering watch channel {channel_body['id']} for Google Drive changes...")
+        channel = self.drive.execute(self.drive.api_client.changes().watch(pageToken=self.page_token, body=channel_body))
+        self.channel_id = channel["id"]
+        self.resource_id = channel["resourceId"]
+        # Google Drive might choose a shorter expiration time than the one requested
+        self.expires_at = int(channel.get("expiration", channel_body["expiration"])) / 1000
+        logger.info(f"Watch channel {self.channel_id} registered. It expires at {time.ctime(self.expires_at)}.")
+
+    def stop(self)->None:
+        """Stops the current watch channel, if any."""
+        if self.channel_id is None:
+            return
+        logger.info(f"Stopping watch channel {self.channel_id}...")
+        try:
+            self.drive.execute(self.drive.api_client.channels().stop(body={"id": self.channel_id, "resourceId": self.resource_id}))
+        except HttpError as e: # (the channel might already have expired)
+            logger.warning(f"Failed to stop watch channel {self.channel_id}: {e}")
+        self.channel_id = self.resource_id = None
+
+    def get_changed_parent_ids(self)->Set[str]:
+        """Lists the changes since this was last called (or since the channel was started).
+
+        :returns The IDs of the folders that the changed files are in."""
+        parent_ids = set()
+        page_token = self.page_token
+        while page_token is not None:
+            response = self.drive.execute(self.drive.api_client.changes().list(pageToken=page_token, fields=CHANGE_LIST_FIELDS, pageSize=1000))
+            for change in response.get("changes", []):
+                if not change.get("removed", False) and "file" in change:
+                    parent_ids.update(change["file"].get("parents", []))
+            if "newStartPageToken" in response: # No more pages
+                self.page_token = response["newStartPageToken"]
+                break
+            page_token = response.get("nextPageToken", None)
+        return parent_ids
+
+    def get_seconds_until_renewal(self, renew_margin:float)->float:
+        """Gets the number of seconds until the channel should be renewed.
+
+        :param renew_margin: How many seconds before the channel expires that it should be renewed."""
+        return self.expires_at - renew_margin - time.time()
+
+    def renew_if_needed(self, renew_margin:float)->None:
+        """Replaces the channel with a new one if it is about to expire.
+
+        :param renew_margin: How many seconds before the channel expires that it should be renewed."""
+        if self.get_seconds_until_renewal(renew_margin) > 0:
+            return
+        logger.info(f"Watch channel {self.channel_id} is about to expire. Renewing...")
+        old_channel_id, old_resource_id = self.channel_id, self.resource_id
+        self.start() # (start the new channel before stopping the old one to not miss any changes)
+        if old_channel_id is not None:
+            try:
+                self.drive.execute(self.drive.api_client.channels().stop(body={"id": old_channel_id, "resourceId": old_resource_id}))
+            except HttpError as e:
+                logger.warning(f"Failed to stop watch channel {old_channel_id}: {e}")
+
+class NotificationReceiver:
+    def __init__(self, host:str, port:int, token:Optional[str]=None):
+        """Initializes a receiver for Google Drive notifications.
+
+        :param host: The host to listen on.
+
+        :param port: The port to listen on.
+
+        :param token: If set (and not empty), notifications without this token are ignored."""
+        self.token = token or None # (an empty token, as in the example configuration, means no token)
+        self.notified = threading.Event()
+        receiver = self
+
+        class NotificationRequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                receiver.handle_notification(self.headers)
+                # Always respond with a success status code, otherwise Google Drive retries the notification
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(f"Notification receiver: {format % args}")
+
+        self.server = ThreadingHTTPServer((host, port), NotificationRequestHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def handle_notification(self, headers)->None:
+        """Handles a notification from Google Drive.
+
+        :param headers: The headers of the notification request. Google Drive sends all details as headers."""
+        if self.token is not None and headers.get("X-Goog-Channel-Token", None) != self.token:
+            logger.warning("Ignoring notification with an invalid token.")
+            return
+        resource_state = headers.get("X-Goog-Resource-State", None)
+        if resource_state == "sync": # Sent when a channel is created
+            logger.debug(f"Watch channel {headers.get('X-Goog-Channel-ID', None)} is working.")
+            return
+        logger.debug(f"Received notification ({resource_state}) on channel {headers.get('X-Goog-Channel-ID', None)}.")
+        self.notified.set()
+
+    def start(self)->None:
+        """Starts receiving notifications in the background."""
+        logger.info(f"Listening for notifications on {self.server.server_address}...")
+        self.server_thread.start()
+
+    def wait(self, timeout:float)->bool:
+        """Waits for a notification.
+
+        :param timeout: The maximum number of seconds to wait.
+
+        :returns True if a notification has been received, False if the wait timed out."""
+        return self.notified.wait(timeout)
+
+    def clear(self)->None:
+        """Marks received notifications as handled."""
+        self.notified.clear()
+
+    def stop(self)->None:
+        """Stops receiving notifications."""
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,166 @@
+"""journal.py
+A write-ahead journal of the steps that have been completed for each file. Processing a file takes multiple steps
+which can not be done atomically: the file is moved on Google Drive, a Notion page is created for it and post-sync
+modules are notified about it. If the script crashes (or an API call fails) between two steps, the journal is used to
+resume the file from the last completed step on the next run, instead of for example creating a second Notion page.
+
+Every step is appended to the journal file (and flushed to disk) before the next step is started. Files go through
+the following states, in order: listed -> moved -> page_created -> notified.
+Files that have been notified are removed from the journal when it is compacted at the end of each run.
+A file that can not be completed (for example because it has been deleted) is only resumed MAX_RESUME_ATTEMPTS times.
+After that it is marked as failed: it stays in the journal but is not resumed again, until it is retried with
+python3 main.py retry."""
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Generator, List, Optional
+from utilities import JOURNAL_FILEPATH, get_logger, append_line, fsync_directory
+
+logger = get_logger(__name__)
+
+FILE_STATES = ["listed", "moved", "page_created", "notified", "failed"]
+# States after which a file is not resumed
+FINAL_STATES = ["notified", "failed"]
+# How many times a file is resumed before it is marked as failed
+MAX_RESUME_ATTEMPTS = 5
+
+class SyncJournal:
+    def __init__(self, filepath:str=JOURNAL_FILEPATH, read_only:bool=False):
+        """Initializes the journal and loads its entries.
+
+        :param filepath: The path to the journal file. Created when the first step is recorded.
+
+        :param read_only: If True, the journal is only read (for example by the plan and status commands): nothing
+        is recorded, and no lock file is created."""
+        self.filepath = filepath
+        self.read_only = read_only
+        # The journal file is replaced when it is compacted, so processes coordinate through a separate lock file
+        self.lock_filepath = filepath + ".lock"
+        self.lock = threading.Lock()
+        self.entries:Dict[str,dict] = {}
+        self.load()
+
+    @contextmanager
+    def locked(self)->Generator[None, None, None]:
+        """Holds an exclusive lock on the journal, both against other threads and other processes.
+        A read-only journal only locks against other threads, and might read a step that is being written as an
+        incomplete line (which is ignored)."""
+        if self.read_only:
+            with self.lock:
+                yield
+            return
+        with self.lock, open(self.lock_filepath, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_entries(self)->Dict[str,dict]:
+        """Replays the journal file.
+
+        :returns A mapping of file ID to the latest entry for the file. Each entry holds everything that has been
+        recorded for the file."""
+        entries = {}
+        if not os.path.exists(self.filepath):
+            return entries
+        with open(self.filepath, encoding="UTF-8") as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError: # (the last line might have been cut off by a crash while it was written)
+                    logger.warning(f"Ignoring incomplete line in the journal: {line!r}")
+                    continue
+                entries.setdefault(record["file_id"], {}).update(record)
+        return entries
+
+    def load(self)->None:
+        """(Re-)loads the entries from the journal file. Needed if other runs might have changed it."""
+        with self.locked():
+            self.entries = self.read_entries()
+
+    def record(self, file_id:str, state:str, **data)->dict:
+        """Records that a step has been completed for a file. Returns once the record is on disk.
+
+        :param file_id: The ID of the file on Google Drive.
+
+        :param state: The state of the file after the step, see FILE_STATES.
+
+        :param data: Any details that are needed to resume from the state.
+
+        :returns The updated entry for the file."""
+        if self.read_only:
+            raise RuntimeError("Can not record steps in a read-only journal.")
+        if state not in FILE_STATES:
+            raise ValueError(f"Unknown journal state {state}. Supported states are: {FILE_STATES}.")
+        record = {"file_id": file_id, "state": state, "recorded_at": time.time(), **data}
+        with self.locked():
+            append_line(self.filepath, json.dumps(record, ensure_ascii=False), sync_to_disk=True)
+            entry = self.entries.setdefault(file_id, {})
+            entry.update(record)
+            return dict(entry)
+
+    def get(self, file_id:str)->Optional[dict]:
+        """Gets the entry for a file, if there is any.
+
+        :param file_id: The ID of the file on Google Drive."""
+        entry = self.entries.get(file_id, None)
+        return dict(entry) if entry is not None else None
+
+    def is_unfinished(self, file_id:str)->bool:
+        """Checks if a file has been started on but not completed (or marked as failed).
+
+        :param file_id: The ID of the file on Google Drive."""
+        entry = self.entries.get(file_id, None)
+        return entry is not None and entry["state"] not in FINAL_STATES
+
+    def is_failed(self, file_id:str)->bool:
+        """Checks if a file has been marked as failed after it could not be resumed MAX_RESUME_ATTEMPTS times.
+
+        :param file_id: The ID of the file on Google Drive."""
+        entry = self.entries.get(file_id, None)
+        return entry is not None and entry["state"] == "failed"
+
+    def get_unfinished(self, profile_name:str)->List[dict]:
+        """Gets the entries of files that have been started on but not completed, for example because of a crash.
+
+        :param profile_name: Only get the files of this sync profile."""
+        return [dict(entry) for entry in self.entries.values()
+                if entry["state"] not in FINAL_STATES and entry.get("profile", None) == profile_name]
+
+    def get_failed(self)->List[dict]:
+        """Gets the entries of files that have been marked as failed, of all sync profiles."""
+        return [dict(entry) for entry in self.entries.values() if entry["state"] == "failed"]
+
+    def retry_failed(self)->int:
+        """Makes files that have been marked as failed be resumed again on the next run, from the step they failed after.
+
+        :returns The number of files that will be retried."""
+        self.load() # (other runs might have recorded steps since the journal was loaded)
+        failed_entries = self.get_failed()
+        for entry in failed_entries:
+            self.record(entry["file_id"], entry["failed_after_state"], resume_attempts=0)
+        return len(failed_entries)
+
+    def compact(self)->int:
+        """Rewrites the journal with only the files that have not been completed (including failed files).
+
+        :returns The number of completed files that were removed."""
+        if self.read_only:
+            raise RuntimeError("Can not compact a read-only journal.")
+        with self.locked():
+            entries = self.read_entries() # (other runs might have recorded steps since the journal was loaded)
+            unfinished_entries = {file_id: entry for file_id, entry in entries.items() if entry["state"] != "notified"}
+            temporary_filepath = self.filepath + ".tmp"
+            with open(temporary_filepath, "w", encoding="UTF-8") as journal_file:
+                for entry in unfinished_entries.values():
+                    journal_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            os.replace(temporary_filepath, self.filepath)
+            fsync_directory(os.path.dirname(os.path.abspath(self.filepath)))
+            self.entries = unfinished_entries
+        return len(entries) - len(unfinished_entries)
@@ -0,0 +1,232 @@
+"""locking.py
+Makes it safe to run multiple syncs at once, for example if a slow run overlaps with the next timer run or if the
+script runs on multiple hosts for availability.
+Before a file is processed, it is claimed by taking a lease on it. A lease expires after a while, so that files that
+were claimed by a run that crashed are picked up again later. Leases are renewed while the run holding them is going.
+Once a Notion page has been created for a file, the file is marked as completed, so that no other run (which might
+run on another host, with its own seen files and journal) processes it again after the lease has been released.
+Leases and completed files are stored by a lock backend: a directory of lock files (default, also works with a shared
+directory) or an SQLite database. The reverse-check folders can also be sharded between workers."""
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+import socket
+import sqlite3
+import time
+import uuid
+import zlib
+from typing import Set
+from utilities import get_logger
+
+logger = get_logger(__name__)
+
+class LockBackend:
+    def acquire(self, key:str, owner:str, lease_seconds:float)->bool:
+        """Tries to take a lease on a key. Override me!
+
+        :param key: The key to take a lease on.
+
+        :param owner: A unique identifier of who is taking the lease.
+
+        :param lease_seconds: How long the lease is valid for.
+
+        :returns True if the lease was taken, False if someone else holds a valid lease on the key."""
+        raise NotImplementedError()
+
+    def release(self, key:str, owner:str)->None:
+        """Releases a lease on a key, if it is held by the owner. Override me!
+
+        :param key: The key to release the lease on.
+
+        :param owner: A unique identifier of who took the lease."""
+        raise NotImplementedError()
+
+    def mark_completed(self, key:str)->None:
+        """Marks a key as completed, permanently. Override me!
+
+        :param key: The key to mark as completed."""
+        raise NotImplementedError()
+
+    def is_completed(self, key:str)->bool:
+        """Checks if a key has been marked as completed. Override me!
+
+        :param key: The key to check."""
+        raise NotImplementedError()
+
+class FileLockBackend(LockBackend):
+    def __init__(self, directory:str):
+        """A lock backend which stores each lease as a file in a directory.
+        The directory may be shared between hosts (for example over NFS) to coordinate them.
+
+        :param directory: The directory to store lock files in. Created if it does not exist."""
+        self.directory = directory
+        if not os.path.exists(self.directory):
+            logger.info("Creating directory for lock files...")
+            os.makedirs(self.directory)
+        self.guard_filepath = os.path.join(self.directory, ".guard")
+
+    def get_lock_filepath(self, key:str)->str:
+        """Gets the path to the lock file of a key."""
+        return os.path.join(self.directory, f"{key}.lock")
+
+    def get_completed_filepath(self, key:str)->str:
+        """Gets the path to the file that marks a key as completed."""
+        return os.path.join(self.directory, f"{key}.completed")
+
+    def read_lease(self, key:str)->dict|None:
+        """Reads the current lease on a key, if any."""
+        try:
+            with open(self.get_lock_filepath(key), encoding="UTF-8") as lock_file:
+                return json.loads(lock_file.read())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def acquire(self, key:str, owner:str, lease_seconds:float)->bool:
+        # All changes to leases are done while holding an exclusive lock on a guard file, so that checking and
+        # taking a lease can not be interleaved with another process doing the same.
+        with open(self.guard_filepath, "a") as guard_file:
+            fcntl.flock(guard_file, fcntl.LOCK_EX)
+            try:
+                lease = self.read_lease(key)
+                if lease is not None and lease["owner"] != owner and lease["expires_at"] > time.time():
+                    return False
+                lock_filepath = self.get_lock_filepath(key)
+                with open(lock_filepath + ".tmp", "w", encoding="UTF-8") as lock_file:
+                    lock_file.write(json.dumps({"owner": owner, "expires_at": time.time() + lease_seconds}))
+                os.replace(lock_filepath + ".tmp", lock_filepath)
+                return True
+            finally:
+                fcntl.flock(guard_file, fcntl.LOCK_UN)
+
+    def release(self, key:str, owner:str)->None:
+        with open(self.guard_filepath, "a") as guard_file:
+            fcntl.flock(guard_file, fcntl.LOCK_EX)
+            try:
+                lease = self.read_lease(key)
+                if lease is not None and lease["owner"] == owner:
+                    os.remove(self.get_lock_filepath(key))
+            finally:
+                fcntl.flock(guard_file, fcntl.LOCK_UN)
+
+    def mark_completed(self, key:str)->None:
+        with open(self.get_completed_filepath(key), "a"):
+            pass
+
+    def is_completed(self, key:str)->bool:
+        return os.path.exists(self.get_completed_filepath(key))
+
+class SQLiteLockBackend(LockBackend):
+    def __init__(self, database_filepath:str):
+        """A lock backend which stores leases in an SQLite database.
+
+        :param database_filepath: The path to the database. Created if it does not exist."""
+        self.database_filepath = database_filepath
+        self.connection = sqlite3.connect(self.database_filepath, timeout=30, isolation_level=None)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS completed (key TEXT PRIMARY KEY, completed_at REAL NOT NULL)")
+
+    def acquire(self, key:str, owner:str, lease_seconds:float)->bool:
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE") # (takes the write lock right away)
+        try:
+            self.connection.execute("INSERT OR IGNORE INTO leases (key, owner, expires_at) VALUES (?, ?, 0)", (key, owner))
+            cursor = self.connection.execute("UPDATE leases SET owner = ?, expires_at = ? WHERE key = ? AND (owner = ? OR expires_at <= ?)",
+                                             (owner, now + lease_seconds, key, owner, now))
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 1
+
+    def release(self, key:str, owner:str)->None:
+        self.connection.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+
+    def mark_completed(self, key:str)->None:
+        self.connection.execute("INSERT OR IGNORE INTO completed (key, completed_at) VALUES (?, ?)", (key, time.time()))
+
+    def is_completed(self, key:str)->bool:
+        return self.connection.execute("SELECT 1 FROM completed WHERE key = ?", (key,)).fetchone() is not None
+
+# Mapping of lock backend names (as set in the configuration) to backend classes
+LOCK_BACKENDS = {
+    "file": FileLockBackend,
+    "sqlite": SQLiteLockBackend
+}
+
+def is_assigned_to_worker(key:str, worker_index:int, worker_count:int)->bool:
+    """Checks if a piece of work belongs to a worker's shard.
+
+    :param key: An identifier of the work, such as the ID of a folder.
+
+    :param worker_index: The index of the worker (starting at 0).
+
+    :param worker_count: The total number of workers that shard work between them."""
+    if not 0 <= worker_index < worker_count:
+        raise ValueError(f"Invalid worker index {worker_index} for {worker_count} workers.")
+    return zlib.crc32(key.encode("UTF-8")) % worker_count == worker_index
+
+class WorkClaimer:
+    def __init__(self, backend:LockBackend, lease_seconds:float=3600):
+        """Claims work for this process so that it is not done twice by concurrent runs.
+
+        :param backend: The lock backend to store leases in.
+
+        :param lease_seconds: How long a claim is valid for. Claims are renewed while they are held (see renew_all()),
+        so this only needs to be longer than it takes to process a file."""
+        self.backend = backend
+        self.lease_seconds = lease_seconds
+        self.last_renewal = time.monotonic()
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex}"
+        self.claimed_keys:Set[str] = set()
+
+    def claim(self, key:str)->bool:
+        """Claims a piece of work, such as a file.
+
+        :param key: An identifier of the work, such as the Google Drive ID of a file.
+
+        :returns True if the work was claimed and should be done by this process, False if someone else is doing it."""
+        if not self.backend.acquire(key, self.owner, self.lease_seconds):
+            logger.info(f"{key} is claimed by another run. Skipping it.")
+            return False
+        self.claimed_keys.add(key)
+        return True
+
+    def release(self, key:str)->None:
+        """Releases a claim on a piece of work.
+
+        :param key: An identifier of the work."""
+        self.backend.release(key, self.owner)
+        self.claimed_keys.discard(key)
+
+    def release_all(self)->None:
+        """Releases all claims held by this process."""
+        for key in list(self.claimed_keys):
+            self.release(key)
+
+    def renew_all(self, force:bool=False)->None:
+        """Renews all claims held by this process, so that they do not expire while the run is still going.
+        Claims are only renewed once a third of the lease has passed since they were last renewed, so this can be
+        called often.
+
+        :param force: If True, renew the claims regardless of when they were last renewed."""
+        if not force and time.monotonic() - self.last_renewal < self.lease_seconds / 3:
+            return
+        self.last_renewal = time.monotonic()
+        for key in list(self.claimed_keys):
+            if not self.backend.acquire(key, self.owner, self.lease_seconds):
+                logger.warning(f"The claim on {key} expired and was taken by another run before it could be renewed.")
+                self.claimed_keys.discard(key)
+
+    def mark_completed(self, key:str)->None:
+        """Marks a piece of work as done, so that it is never claimed again by any run.
+
+        :param key: An identifier of the work."""
+        self.backend.mark_completed(key)
+
+    def is_completed(self, key:str)->bool:
+        """Checks if a piece of work has been done by any run.
+
+        :param key: An identifier of the work."""
+        return self.backend.is_completed(key)
@@ -1,235 +1,143 @@
 """main.py
-Runs the syncing code."""
-import io
-import os.path
-import tempfile
-from utilities import WORKING_DIR, TEMPORARY_FILES_DIR, get_logger, get_config, get_tags, get_seen_files, update_seen_files
-from notion_api.notion import NotionAPIClient
-from notion_api.database_fields import NotionTitleDatabaseField, NotionMultiSelectDatabaseField, NotionRichTextDatabaseField, DATABASE_FIELDS as NOTION_DATABASE_FIELD_CLASSES
-from notion_api.page_blocks import NotionPageEmbedBlock, NotionPageHeading2Block, NotionPageQuoteBlock, NotionPageURLBlock, NotionPageParagraphBlock
-from google_drive.authorization import DriveAPIHandler
-from tag_detector import TagDetector
-from googleapiclient.http import MediaIoBaseDownload
-from typing import Optional, Tuple, List
-from post_sync import POST_SYNC_ACTIONS
-
-import logging
-# Get a logger
-logger = get_logger(__name__)
-# Get the config
-CONFIG = get_config()
-NOTION_CONFIG = CONFIG["notion"]
-NOTION_AUTH_TOKEN = NOTION_CONFIG["auth_token"]
-NOTION_DATABASE_ID = NOTION_CONFIG["upload_database_id"]
-NOTION_DOCUMENT_NAME_FIELD_NAME = NOTION_CONFIG["document_name_field_name"]
-NOTION_GOOGLE_DRIVE_ID_FIELD_NAME = NOTION_CONFIG["google_drive_id_field_name"]
-# Load ptional Notion settings
-NOTION_NEW_PAGE_ICON = NOTION_CONFIG.get("new_page_icon", None) # (icon is optional)
-NOTION_NEW_PAGE_INFORMATION_BANNER = NOTION_CONFIG.get("include_information_banner", True) # (optional setting)
-NOTION_NEW_PAGE_EMBED_DOCUMENT_INLINE = NOTION_CONFIG.get("embed_document_inline", True) # (optional setting)
-NOTION_TAG_TYPES = NOTION_CONFIG["tag_types"]
-GOOGLE_DRIVE_CONFIG = CONFIG["google_drive"]
-GOOGLE_DRIVE_UPLOAD_FOLDER_ID = GOOGLE_DRIVE_CONFIG["upload_folder_id"]
-
-# Clean up any temporary paths
-temporary_files_removed = 0
-for temporary_path in os.listdir(TEMPORARY_FILES_DIR):
-    os.remove(os.path.join(TEMPORARY_FILES_DIR, temporary_path))
-    temporary_files_removed+=1
-
-if temporary_files_removed > 0:
-    logger.info(f"Found {temporary_files_removed} temporary files to remove.")
-else:
-    logger.debug("No temporary files to remove.")
-
-# Create API clients
-notion = NotionAPIClient(NOTION_AUTH_TOKEN)
-drive = DriveAPIHandler()
-drive.authorize() # Ensure authorization
-
-# Create a tag detector
-tag_detector = TagDetector(get_tags())
-logger.info("API clients created, all token stuff retrieved! ✨")
-
-# List files in the Google Drive directory
-files = drive.list_all_files_in_directory(GOOGLE_DRIVE_UPLOAD_FOLDER_ID)
-number_of_files = len(files)
-logger.info("Received {} {} to process...".format(
-    number_of_files,
-    'file' if number_of_files == 1 else 'files'
-))
-
-def get_file_details(file_object:dict, apply_tags:Optional[List[dict]]=None)->Tuple[str,str,str,str,List[str]]:
-    """Retrieves all the file details that we need for linking the file.
-    Also downloads the file to a temporary file path.
-
-    :param file_object: Data for the file as a response dict returned by the Google API.
-
-    :param apply_tags: If set, a list of tags to apply to the file regardless.
-
-    :returns A tuple consisting of: The file ID, the target drive directory, the file title, a temporary path where the file
-    is accessible, and the Notion tags for it."""
-    # Get data for the file
-    filename = file_object["name"]
-    file_id = file_object["id"]
-    file_extension = os.path.splitext(filename)[1]
-    logger.info(f"Processing file {file_id} ({filename})...")
-    # Get which directory to put it in
-    target_google_drive_directory, notion_tags, file_title = tag_detector.get_drive_folder_from_filename(filename, apply_tags)
-    logger.info(
-        f"Found directory and tags for file {filename} ({file_id}): {target_google_drive_directory} and {notion_tags}.")
-    # Download file
-    # Even though Notion doesn't support it, the implementation of post-checks (see README.md)
-    # hands over the temporary file so Notion can do stuff with it.
-    # Create temporary path in temporary files directory for downloading
-    temporary_path = tempfile.mktemp(suffix=file_extension, dir=TEMPORARY_FILES_DIR)
-    # Prepare file for writing
-    file = open(temporary_path, "wb")
-    # Start downloading the file
-    file_download = drive.api_client.files().get_media(fileId=file_id)
-    downloader = MediaIoBaseDownload(file, file_download)
-    done = False
-    while not done:
-        status, done = downloader.next_chunk()
-        logger.info(f"Downloading file {file_id}... {round(status.progress() * 100, 2)}/100%")
-    logger.info(f"File {file_id} downloaded to {temporary_path}.")
-    return file_id, target_google_drive_directory, file_title, temporary_path, notion_tags
-
-def link_file_to_notion(google_drive_file_id, file_title, notion_tags)->Tuple[str,str]:
-    """Links a Google Drive file in Notion by creating a Notion page.
-
-    :param google_drive_file_id: The file ID on Google Drive.
-
-    :param file_title: The file title on Google Drive.
-
-    :param notion_tags: A list of Notion tags to add."""
-    file_link = f"https://drive.google.com/file/d/{google_drive_file_id}/view"
-    logger.info(f"Google Drive link for {file_title} is {file_link}.")
-    logger.info(f"Starting linking for {file_link} with Notion...")
-    # Create a new page for the file
-    new_page_parent = {"database_id": NOTION_DATABASE_ID}
-    # Parse tags to create in Notion
-    new_page_properties = {NOTION_DOCUMENT_NAME_FIELD_NAME: NotionTitleDatabaseField(file_title),
-                           NOTION_GOOGLE_DRIVE_ID_FIELD_NAME: NotionRichTextDatabaseField(file_id)}  # Add what we already have
-    for tag in notion_tags:
-        # Get details for the tag
-        tag_data = NOTION_TAG_TYPES[tag["type"]]
-        # Get Notion type for the tag
-        database_field_type = tag_data["notion_type"]
-        # Create a database field with the details filed out
-        database_field = NOTION_DATABASE_FIELD_CLASSES[database_field_type](tag["value"])
-        new_page_properties[tag_data["name"]] = database_field
-    logger.debug(f"Properties for new page are: {new_page_properties}.")
-    logger.info("Creating new page on Notion...")
-    # Generate page children
-    page_children = []
-    # Add banner saying this page is auto-generated if set
-    if NOTION_NEW_PAGE_INFORMATION_BANNER:
-        page_children.append(
-            NotionPageQuoteBlock(
-                "🤖 This page was automatically created by NotesTionSync."
-            )
-        )
-    page_children.append(NotionPageParagraphBlock("You can find the file at the link below:"))
-    # Add document information: a link to the file in the new page
-    if NOTION_NEW_PAGE_EMBED_DOCUMENT_INLINE:
-        page_children.append(
-            NotionPageURLBlock(file_link)
-        )
-    else:
-        page_children.append(
-            NotionPageEmbedBlock(file_link)
-        )
-    new_page = notion.create_page(
-        new_page_parent,
-        new_page_properties,
-        page_children=page_children, # Add everything to fill out the page with
-        icon=NOTION_NEW_PAGE_ICON
-    )
-    notion_link = new_page["url"]
-    logger.info(f"New Notion page created at: {notion_link}.")
-    return file_link, notion_link
-
-seen_files = initially_seen_files = get_seen_files()
-seen_files_data:List[dict] = []
-for file in files:
-    file_id, target_google_drive_directory, file_title, file_temporary_path, notion_tags = get_file_details(file)
-    # Move file to the directory it should be moved to
-    logger.info("Moving file...")
-    moving_response = drive.api_client.files().update(fileId=file_id, addParents=target_google_drive_directory, removeParents=GOOGLE_DRIVE_UPLOAD_FOLDER_ID).execute()
-    logger.debug(f"The file was moved with response {moving_response}")
-    # Now, link the file to Notion
-    file_link, notion_link = link_file_to_notion(file_id, file_title, notion_tags)
-    seen_files.append(file_id)
-    update_seen_files(seen_files) # Update seen files
-    seen_files_data.append({
-        "file_google_drive_id": file_id,
-        "file_title": file_title,
-        "file_temporary_path": file_temporary_path,
-        "file_google_drive_link": file_link,
-        "notion_new_page_link": notion_link,
-        "notion_tags": notion_tags
-    })
-
-# Next, we do a reverse check. It's a chance someone moved documents directly
-# to the folders instead to the "incoming scan" folders.
-# Therefore, we scan all the files in the folders that the script is configured
-# to move files to and if we discover anything new, we add it to Notion.
-def get_reverse_check_folder_ids(tags:dict):
-    """Reverses the mapping file (tags.json5) for the reverse check (see above).
-
-    :returns A mapping of folder IDs the tags belonging to that move folder ID."""
-    folder_ids_to_tags = {}
-    for tag_id, tag_data in tags.items():
-        # Detect tag type: has subtags or not subtags.
-        if "folder_id" in tag_data:
-            folder_ids_to_tags[tag_data["folder_id"]] = tag_data["notion_tags"]
-        else: # Recursively apply the function
-            folder_ids_to_tags.update(get_reverse_check_folder_ids(tag_data))
-    return folder_ids_to_tags
-
-# Perform the actual reverse check
-reverse_check_folder_ids = get_reverse_check_folder_ids(tag_detector.tag_mappings)
-logger.debug(f"Reverse-checking the following folders: {reverse_check_folder_ids.keys()}")
-for folder_id, folder_tags in reverse_check_folder_ids.items():
-    logger.info(f"Reverse-checking folder {folder_id}...")
-    # List the directory
-    for folder_subfile in drive.list_all_files_in_directory(folder_id):
-        # Only process .pdf files
-        if folder_subfile["mimeType"] != "application/pdf":
-            logger.debug(f"Ignoring file {folder_subfile['name']} (is not PDF)")
-            continue
-        elif folder_subfile["id"] in seen_files:
-            logger.debug(f"Ignoring file {folder_subfile['id']} (is already seen)")
-            continue
-        file_id, target_google_drive_directory, file_title, file_temporary_path, notion_tags = get_file_details(folder_subfile,
-                                                                                               folder_tags)
-        logger.info(f"Found a non-seen file: {file_id}. Linking to Notion...")
-        file_link, notion_link = link_file_to_notion(file_id, file_title, notion_tags)
-        logger.info("Unseen file linked to Notion.")
-        seen_files.append(file_id)
-        seen_files_data.append({
-            "file_google_drive_id": file_id,
-            "file_title": file_title,
-            "file_temporary_path": file_temporary_path,
-            "file_google_drive_link": file_link,
-            "notion_new_page_link": notion_link,
-            "notion_tags": notion_tags
-        })
-        update_seen_files(seen_files) # Update seen files
-logger.info("Notion sync completed. Running post-sync if enabled...")
-POST_SYNC_CONFIG = CONFIG["post_sync"] if "post_sync" in CONFIG else None
-if POST_SYNC_CONFIG is not None and POST_SYNC_CONFIG["enabled"]:
-    logger.info("Running post-sync...")
-    # Get all the enabled post-sync modules
-    POST_SYNC_MODULES = POST_SYNC_CONFIG["enabled_modules"]
-    for enabled_post_sync_module in POST_SYNC_MODULES: # For every enabled module
-        if enabled_post_sync_module not in POST_SYNC_MODULES: # Validate module name
-            logging.critical(f"The post sync module {enabled_post_sync_module} is not supported. Supported modules are: {POST_SYNC_MODULES}.")
-        for seen_file in seen_files_data: # For every updated file
-            post_sync_object = POST_SYNC_ACTIONS[enabled_post_sync_module](**seen_file)
-            post_sync_object.run()
-            logger.debug(f"Post-sync for file {seen_file['file_title']} completed.")
-    logger.info("Post-sync completed.")
-else:
-    logger.info("No post-sync to be ran. Program completed.")
\ No newline at end of file
+The command line interface. Run python3 main.py --help to see the available commands.
+Each command only imports what it needs when it is run, so that quick commands like status start without loading
+the Google and Notion libraries. The syncing itself is done in runner.py."""
+import argparse
+from datetime import datetime
+from typing import List, Optional
+
+def run_sync_command(arguments:argparse.Namespace)->None:
+    """Syncs once, or keeps syncing in push mode if it is enabled."""
+    from utilities import get_config
+    from runner import run
+    run(get_config())
+
+def run_backfill_command(arguments:argparse.Namespace)->None:
+    """Links files that were added to the folders directly, without processing the upload folder."""
+    from utilities import get_config
+    from runner import run
+    run(get_config(), backfill=True, modified_after=arguments.modified_after)
+
+def run_plan_command(arguments:argparse.Namespace)->None:
+    """Outputs what a sync would do without doing it."""
+    from utilities import get_config
+    from runner import run_plan
+    run_plan(get_config(), arguments.output)
+
+def run_retry_command(arguments:argparse.Namespace)->None:
+    """Makes files that failed to be resumed too many times be resumed again on the next sync."""
+    from journal import SyncJournal
+    number_of_files = SyncJournal().retry_failed()
+    print(f"{number_of_files} failed {'file' if number_of_files == 1 else 'files'} will be retried on the next sync.")
+
+def format_timestamp(timestamp:float)->str:
+    """Formats a UNIX timestamp for printing, in local time."""
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+def print_file_record(file_record)->None:
+    """Prints what is known about a synced file.
+
+    :param file_record: A FileRecord, see state_store.py."""
+    print(f"  Title: {file_record.title} (profile {file_record.profile})")
+    print(f"  Google Drive: https://drive.google.com/file/d/{file_record.file_id}/view")
+    print(f"  Last {'synced' if file_record.status == 'synced' else 'failed'}: {format_timestamp(file_record.synced_at)} (run {file_record.run_id})")
+    if file_record.notion_page_url is not None:
+        print(f"  Notion page: {file_record.notion_page_url}")
+    if file_record.error is not None:
+        print(f"  Error: {file_record.error}")
+
+def run_status_command(arguments:argparse.Namespace)->None:
+    """Prints how many files have been synced, if any files have not been completed, and the history of files and runs.
+    Only reads local files, so this does not need the configuration or any API access."""
+    from utilities import get_seen_files
+    from journal import SyncJournal
+    from state_store import StateStore
+    seen_files = set(get_seen_files())
+    journal = SyncJournal(read_only=True)
+    state_store = StateStore()
+    if arguments.file is not None:
+        journal_entry = journal.get(arguments.file)
+        print(f"File {arguments.file}: {'seen' if arguments.file in seen_files else 'not seen'}", end="")
+        print(f" (last step in the journal: {journal_entry['state']})" if journal_entry is not None else "")
+        if journal_entry is not None and journal_entry["state"] == "failed":
+            print(f"  Gave up after {journal_entry['resume_attempts']} attempts to resume after step {journal_entry['failed_after_state']}: {journal_entry['error']}")
+        file_record = state_store.get_file(arguments.file)
+        if file_record is not None:
+            print_file_record(file_record)
+        return
+    if arguments.notion_page is not None:
+        file_record = state_store.get_file_by_notion_page(arguments.notion_page)
+        if file_record is None:
+            print(f"No synced file found for Notion page {arguments.notion_page}.")
+            return
+        print(f"Notion page {arguments.notion_page} is for file {file_record.file_id}:")
+        print_file_record(file_record)
+        return
+    if arguments.runs is not None:
+        for run_record in state_store.get_recent_runs(arguments.runs):
+            files_per_minute = run_record.files_synced / run_record.duration_seconds * 60 if run_record.duration_seconds > 0 else 0
+            print(f"{format_timestamp(run_record.started_at)} {run_record.command} {run_record.status}: {run_record.files_synced} synced, "
+                  f"{run_record.files_failed} failed in {run_record.duration_seconds:.1f} s ({files_per_minute:.1f} files/minute)"
+                  + (f". Error: {run_record.error}" if run_record.error is not None else ""))
+        return
+    if arguments.failures is not None:
+        for file_record in state_store.get_failures(arguments.failures):
+            print(f"{format_timestamp(file_record.synced_at)} {file_record.file_id} ({file_record.title}): {file_record.error}")
+        return
+    if arguments.throughput is not None:
+        for period_start, number_of_files in state_store.get_throughput(arguments.throughput):
+            print(f"{format_timestamp(period_start)}: {number_of_files} files synced")
+        return
+    print(f"Seen files: {len(seen_files)}")
+    unfinished_entries = [entry for entry in journal.entries.values() if journal.is_unfinished(entry["file_id"])]
+    states = {}
+    for entry in unfinished_entries:
+        states[entry["state"]] = states.get(entry["state"], 0) + 1
+    print(f"Unfinished files: {len(unfinished_entries)}" + (f" ({', '.join(f'{state}: {count}' for state, count in states.items())})" if states else ""))
+    failed_entries = journal.get_failed()
+    if len(failed_entries) > 0:
+        print(f"Failed files (not resumed anymore, run python3 main.py retry to retry them): {len(failed_entries)}")
+        for entry in failed_entries:
+            print(f"  {entry['file_id']} ({entry['file']['name']}) after step {entry['failed_after_state']}: {entry['error']}")
+    recent_runs = state_store.get_recent_runs(1)
+    if len(recent_runs) > 0:
+        print(f"Last run: {format_timestamp(recent_runs[0].started_at)} ({recent_runs[0].status}, {recent_runs[0].files_synced} files synced)")
+
+def get_argument_parser()->argparse.ArgumentParser:
+    """Creates the parser for the command line arguments."""
+    argument_parser = argparse.ArgumentParser(description="Syncs files from Google Drive to Notion.")
+    subparsers = argument_parser.add_subparsers(dest="command", metavar="command",
+                                                help="What to do. Defaults to sync if no command is given.")
+    sync_parser = subparsers.add_parser("sync", help="Sync once (or keep syncing if push notifications are enabled).")
+    sync_parser.set_defaults(function=run_sync_command)
+    backfill_parser = subparsers.add_parser("backfill", help="Only link files that have been added directly to the folders that files are moved to.")
+    backfill_parser.add_argument("--modified-after", type=datetime.fromisoformat, default=None,
+                                 help="Only check files modified after this time (for example 2024-01-31 or 2024-01-31T12:00).")
+    backfill_parser.set_defaults(function=run_backfill_command)
+    plan_parser = subparsers.add_parser("plan", help="Output what a sync would do without doing anything.")
+    plan_parser.add_argument("--output", default=None, help="A file to write the plan to instead of printing it.")
+    plan_parser.set_defaults(function=run_plan_command)
+    retry_parser = subparsers.add_parser("retry", help="Retry files that failed to sync too many times on the next sync.")
+    retry_parser.set_defaults(function=run_retry_command)
+    status_parser = subparsers.add_parser("status", help="Show how many files have been synced, any files that have not been completed, "
+                                                         "and the history of files and runs.")
+    status_parser.add_argument("--file", default=None, help="The Google Drive ID of a file to show the status of.")
+    status_parser.add_argument("--notion-page", default=None, help="The ID of a Notion page to show the file of.")
+    status_parser.add_argument("--runs", type=int, nargs="?", const=10, default=None, help="Show the latest runs (10 by default).")
+    status_parser.add_argument("--failures", type=int, nargs="?", const=10, default=None,
+                               help="Show the latest files that failed to sync (10 by default).")
+    status_parser.add_argument("--throughput", type=int, nargs="?", const=7, default=None, metavar="DAYS",
+                               help="Show how many files were synced each day (for the last 7 days by default).")
+    status_parser.set_defaults(function=run_status_command)
+    argument_parser.set_defaults(function=run_sync_command)
+    return argument_parser
+
+def main(argv:Optional[List[str]]=None)->None:
+    """Runs the script.
+
+    :param argv: The command line arguments. Defaults to the arguments the script was started with."""
+    arguments = get_argument_parser().parse_args(argv)
+    arguments.function(arguments)
+
+if __name__ == "__main__":
+    main()
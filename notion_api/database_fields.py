@@ -1,9 +1,13 @@
 """database_fields.py
 Defines some Notion database fields."""
+from typing import List, Union
 from .fields import Field
 
 
 class NotionDatabaseField(Field):
+    # Set to True for fields that can hold multiple values (such as multi-selects)
+    SUPPORTS_MULTIPLE_VALUES = False
+
     def __init__(self, field_type:str, main_parameter:str):
         """Defines a database field on Notion.
         
@@ -21,19 +25,22 @@ class NotionDatabaseField(Field):
 
 class NotionMultiSelectDatabaseField(NotionDatabaseField):
     """Class for a Notion multi-select database field."""
-    def __init__(self, main_parameter:str):
+    SUPPORTS_MULTIPLE_VALUES = True
+
+    def __init__(self, main_parameter:Union[str, List[str]]):
         """Initializes a multi-select database field.
 
-        :param main_parameter: The main text parameter/value in the database field.
-        This varies from field to field and is preset to avoid any configuration hassles."""
+        :param main_parameter: The ID of the option to select, or a list of IDs to select multiple options."""
         super().__init__("database", main_parameter)
 
     def __dict__(self) ->dict:
+        option_ids = [self.main_parameter] if isinstance(self.main_parameter, str) else self.main_parameter
         return {
             "multi_select": [
                 {
-                    "id": self.main_parameter
+                    "id": option_id
                 }
+                for option_id in option_ids
             ]
         }
 
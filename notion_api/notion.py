@@ -7,9 +7,11 @@ from typing import Optional, List, Dict, Union
 from .database_fields import NotionDatabaseField
 from .fields import Field
 from .page_blocks import NotionPageBlock
+from .rate_limiter import RateLimiter
 import requests, time
 
 from utilities import get_logger
+from concurrency import AdaptiveConcurrencyLimiter
 
 
 class NotionUnexpectedStatusCode(Exception):
@@ -19,8 +21,26 @@ class NotionRequestFailed(Exception):
     pass
 
 class NotionAPIClient:
-    def __init__(self, token, notion_api_version="2022-06-28"):
-        """Initializes a Notion API client."""
+    # Notion does not accept more than 100 blocks in a single request
+    MAX_BLOCK_CHILDREN_PER_REQUEST = 100
+
+    def __init__(self, token, notion_api_version="2022-06-28", rate_limiter:Optional[RateLimiter]=None, session:Optional[requests.Session]=None,
+                 concurrency_limiter:Optional[AdaptiveConcurrencyLimiter]=None):
+        """Initializes a Notion API client.
+
+        :param token: The Notion API token.
+
+        :param notion_api_version: The Notion API version to use.
+
+        :param rate_limiter: A rate limiter to pace requests with. Pass the same rate limiter to multiple clients
+        to share it between them. If not set, a new rate limiter is created.
+
+        :param session: A requests session to send requests with, which reuses connections between requests.
+        If not set, a new session is created.
+
+        :param concurrency_limiter: A limiter for how many requests may be in flight at once, which backs off when
+        Notion is overloaded. Pass the same limiter to multiple clients to share it between them. If not set, a new
+        limiter is created."""
         self.token = token
         self.notion_api_version = notion_api_version
         if self.notion_api_version != "2022-06-28":
@@ -32,25 +52,36 @@ class NotionAPIClient:
                 "Notion-Version": self.notion_api_version
             }
         }
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.session = session if session is not None else requests.Session()
+        self.concurrency_limiter = concurrency_limiter if concurrency_limiter is not None else AdaptiveConcurrencyLimiter("notion")
 
     def send_request(self, request_method, api_method, request_json=None, expected_status_codes:Optional[List[int]]=None):
         """Sends an authenticated request to Notion and returns the response."""
         if expected_status_codes is None:
             expected_status_codes = [200]
         self.logger.debug("Sending request to Notion...")
-        request_kwargs = self.default_request_kwargs
+        request_kwargs = dict(self.default_request_kwargs) # (copy to not leak details between requests)
         request_kwargs["method"] = request_method
         request_kwargs["url"] = f"https://api.notion.com/v1{api_method}"
         if request_json is not None:
             request_kwargs["json"] = request_json
         self.logger.debug(f"Sending request to Notion at {request_kwargs['url']} with details {request_kwargs}...")
         # Send request
+        self.rate_limiter.wait()
+        # Requests to the same endpoint take about as long as each other, see AdaptiveConcurrencyLimiter.release()
+        request_type = f"{request_method} /{api_method.split('/')[1]}"
+        request_start_time = self.concurrency_limiter.acquire()
         try:
-            response = requests.request(**request_kwargs)
+            response = self.session.request(**request_kwargs)
         except Exception as e:
+            self.concurrency_limiter.release(request_start_time, overloaded=True, request_type=request_type)
             error_message = f"Notion request failed with error {e}."
             self.logger.critical(error_message)
             raise NotionRequestFailed(error_message)
+        # Back off on rate limits and server errors
+        self.concurrency_limiter.release(request_start_time, overloaded=response.status_code == 429 or response.status_code >= 500,
+                                         request_type=request_type)
         if response.status_code not in expected_status_codes:
             if response.status_code == 429: # Detect rate limits
                 # According to the documentation, rate limits have a Retry-After header
@@ -62,7 +93,7 @@ class NotionAPIClient:
                 # Retry request after rate limit is finished
                 self.logger.info("Retrying request...")
                 # Call the function with the original arguments
-                self.send_request(request_method, api_method, request_json, expected_status_codes)
+                return self.send_request(request_method, api_method, request_json, expected_status_codes)
             else:
                 error_message = f"Unexpected status code received from Notion: {response.status_code}. Content: {response.content}"
                 raise Exception(error_message)
@@ -76,6 +107,24 @@ class NotionAPIClient:
         self.logger.info("Database data successfully retrieved.")
         return response.json()
 
+    def query_database(self, database_id:str, query_filter:Optional[dict]=None, page_size:int=100)->List[dict]:
+        """Queries a database for pages.
+
+        :param database_id: The ID of the database.
+
+        :param query_filter: A filter for the pages to return. See Notions documentation for more details.
+
+        :param page_size: The most pages to return (at most 100).
+
+        :returns The first page of results: the pages that match the filter."""
+        self.logger.info(f"Querying database {database_id} on Notion...")
+        request_json = {"page_size": page_size}
+        if query_filter is not None:
+            request_json["filter"] = query_filter
+        response = self.send_request("POST", f"/databases/{database_id}/query", request_json)
+        self.logger.info("Database successfully queried.")
+        return response.json()["results"]
+
     def combine_fields(self, types:dict|list, fields:Dict[str,Field], initial_data:Optional[dict]=None)->dict|list:
         """A utility to add a render of fields (see the Field class that multiple properties (e.g. NotionDatabaseField) derives from) to a dictionary.
 
@@ -105,39 +154,84 @@ class NotionAPIClient:
         a database.
 
         :param page_properties: Properties for the new page."""
-        self.logger.info(f"Creating a new page with details {page_properties}...")
         # Generate NotionDatabaseField JSON by combining arguments.
         # Add all properties by converting them to dict
         properties = self.combine_fields(dict, page_properties)
+        # Add all NotionPageBlock properties by converting them to dict
+        page_children_data = self.combine_fields(list, page_children) if page_children is not None else None
+        return self.create_page_from_data(parent, properties, page_children_data, icon, cover)
+
+    def create_page_from_data(self, parent:dict, properties:dict, page_children:Optional[List[dict]]=None, icon:Optional[dict]=None, cover:Optional[dict]=None):
+        """Function for creating a new page from properties and page children that have already been rendered
+        (converted to dict). See create_page() for creating a page from fields.
+
+        :param parent: The parent of the page. See Notions documentation for more details. The parent might be a page or
+        a database.
+
+        :param properties: Rendered properties for the new page.
+
+        :param page_children: Rendered page blocks to add to the new page."""
+        self.logger.info(f"Creating a new page with details {properties}...")
         request_json = {
             "parent": parent,
             "properties": properties
         }
         # Add additional parameters if set
         if page_children is not None:
-            # Add all NotionPageBlock properties by converting them to dict
-            page_children_data = self.combine_fields(list, page_children)
-            request_json["children"] = page_children_data
+            # Create the page with the first batch of children and append the rest afterwards
+            request_json["children"] = page_children[:self.MAX_BLOCK_CHILDREN_PER_REQUEST]
         if icon is not None:
             request_json["icon"] = icon
         if cover is not None:
             request_json["cover"] = cover
         response = self.send_request("POST", "/pages", request_json)
         self.logger.info("Page successfully created.")
-        return response.json()
+        new_page = response.json()
+        if page_children is not None and len(page_children) > self.MAX_BLOCK_CHILDREN_PER_REQUEST:
+            self.append_block_children_from_data(new_page["id"], page_children[self.MAX_BLOCK_CHILDREN_PER_REQUEST:])
+        return new_page
+
+    def append_block_children(self, block_id:str, children:List[NotionPageBlock])->List[dict]:
+        """Appends blocks to a block or page.
+
+        :param block_id: The ID of the block or page to append blocks to.
+
+        :param children: The blocks to append. Any number of blocks may be passed: they are sent in batches."""
+        return self.append_block_children_from_data(block_id, self.combine_fields(list, children))
+
+    def append_block_children_from_data(self, block_id:str, children:List[dict])->List[dict]:
+        """Appends blocks that have already been rendered (converted to dict) to a block or page.
+        See append_block_children() for appending blocks from fields.
+
+        :param block_id: The ID of the block or page to append blocks to.
+
+        :param children: The rendered blocks to append. Any number of blocks may be passed: they are sent in batches
+        of up to 100 blocks, which is the maximum that Notion accepts.
+
+        :returns The responses from Notion, one for each batch."""
+        responses = []
+        number_of_batches = -(-len(children) // self.MAX_BLOCK_CHILDREN_PER_REQUEST)
+        self.logger.info(f"Appending {len(children)} blocks to {block_id} in {number_of_batches} batches...")
+        # Batches are sent one after another to keep the blocks in order, paced only by the rate limiter.
+        for batch_start in range(0, len(children), self.MAX_BLOCK_CHILDREN_PER_REQUEST):
+            batch = children[batch_start:batch_start + self.MAX_BLOCK_CHILDREN_PER_REQUEST]
+            response = self.send_request("PATCH", f"/blocks/{block_id}/children", {"children": batch})
+            responses.append(response.json())
+        self.logger.info("Blocks successfully appended.")
+        return responses
 
-    def update_page(self, page_id:str, new_properties:Optional[List[NotionPageBlock]]=None,
+    def update_page(self, page_id:str, new_properties:Optional[Dict[str, NotionDatabaseField]]=None,
                     archived:Optional[bool]=None, icon:Optional[dict]=None, cover:Optional[dict]=None):
         """Updates a notion page.
 
         :param page_id: The ID of the page.
 
-        :param things_to_update: The things to update in the page. Note that this is in dict format."""
+        :param new_properties: Properties to update on the page."""
         self.logger.info(f"Updating Notion page: {page_id}...")
         request_json = {}
         if new_properties is not None:
             #  Combine properties into dict and add them to the request
-            request_json["properties"] = self.combine_fields(list, new_properties)
+            request_json["properties"] = self.combine_fields(dict, new_properties)
         # Add additional things
         if archived is not None:
             request_json["archived"] = archived
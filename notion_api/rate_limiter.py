@@ -0,0 +1,34 @@
+"""rate_limiter.py
+A simple rate limiter for keeping requests to Notion below its rate limit.
+Notion allows an average of three requests per second, with some bursts allowed."""
+import threading
+import time
+
+DEFAULT_REQUESTS_PER_SECOND = 3
+
+class RateLimiter:
+    def __init__(self, requests_per_second:float=DEFAULT_REQUESTS_PER_SECOND, burst:int=3):
+        """Initializes a token bucket rate limiter. It is thread-safe, so it can be shared between clients and threads.
+
+        :param requests_per_second: The average number of requests to allow per second.
+
+        :param burst: The maximum number of requests that may be sent at once after being idle."""
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self)->None:
+        """Waits until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                # Refill tokens for the time that has passed
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.requests_per_second)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time_to_wait = (1 - self.tokens) / self.requests_per_second
+            time.sleep(time_to_wait)
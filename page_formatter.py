@@ -1,19 +1,122 @@
 """page_formatter.py
-Since everyone's Notion Database is different, you have to customize and create a page formatter
-function that fills out a page with all the details you want.
-See the implementation below."""
+Since everyone's Notion Database is different, the page formatter fills out a new page with the details set in the
+configuration file: the title, the Google Drive ID, the tags and the page content.
+Files with the same tags get pages that only differ in their title, Google Drive ID and link, so the rest of the
+page is rendered once per tag path and then reused. See the implementation below."""
+from typing import Dict, List, Tuple
+from notion_api.database_fields import NotionTitleDatabaseField, NotionRichTextDatabaseField, DATABASE_FIELDS as NOTION_DATABASE_FIELD_CLASSES
+from notion_api.page_blocks import NotionPageEmbedBlock, NotionPageQuoteBlock, NotionPageURLBlock, NotionPageParagraphBlock
+from utilities import get_logger
+
+logger = get_logger(__name__)
+
+class PageTemplate:
+    def __init__(self, properties:dict, page_children:List[dict]):
+        """A rendered page, without the details that differ between files.
+
+        :param properties: Rendered page properties for the tags.
+
+        :param page_children: Rendered page blocks to put before the link to the file."""
+        self.properties = properties
+        self.page_children = page_children
 
 class PageFormatter:
-    def __init__(self):
-        pass
-
-
-    def format_according_to_data(self, document_title):
-        return {
-            "Namn": {
-                "title": document_title
-            },
-            "Typ": {
-                "title": "Anteckning"
-            }
-        }
\ No newline at end of file
+    def __init__(self, document_name_field_name:str, google_drive_id_field_name:str, tag_types:dict,
+                 include_information_banner:bool=True, embed_document_inline:bool=True):
+        """Initializes a page formatter.
+
+        :param document_name_field_name: The name of the title field in the Notion database.
+
+        :param google_drive_id_field_name: The name of the field where the Google Drive ID is stored.
+
+        :param tag_types: The tag types from the configuration file (notion.tag_types).
+
+        :param include_information_banner: If True, add a banner saying that the page was automatically created.
+
+        :param embed_document_inline: If True, add the link to the file as a link rather than as an embed."""
+        self.document_name_field_name = document_name_field_name
+        self.google_drive_id_field_name = google_drive_id_field_name
+        self.tag_types = tag_types
+        self.include_information_banner = include_information_banner
+        self.embed_document_inline = embed_document_inline
+        self.templates:Dict[Tuple[Tuple[str,str],...], PageTemplate] = {}
+
+    def get_template_key(self, notion_tags:List[dict])->Tuple[Tuple[str,str],...]:
+        """Gets the key that a template is cached under.
+
+        :param notion_tags: A list of Notion tags to add."""
+        return tuple((tag["type"], tag["value"]) for tag in notion_tags)
+
+    def compile_template(self, notion_tags:List[dict])->PageTemplate:
+        """Renders the parts of a page that are the same for all files with the same tags.
+
+        :param notion_tags: A list of Notion tags to add."""
+        logger.debug(f"Compiling page template for tags {notion_tags}...")
+        # Group the tag values by the property they should be set in, so that multiple tags of the same type
+        # are merged into one property rather than overwriting each other.
+        property_values:Dict[str, List[str]] = {}
+        property_types:Dict[str, str] = {}
+        for tag in notion_tags:
+            # Get details for the tag
+            tag_data = self.tag_types[tag["type"]]
+            property_values.setdefault(tag_data["name"], [])
+            if tag["value"] not in property_values[tag_data["name"]]:
+                property_values[tag_data["name"]].append(tag["value"])
+            # Get Notion type for the tag
+            property_types[tag_data["name"]] = tag_data["notion_type"]
+        properties = {}
+        for property_name, values in property_values.items():
+            database_field_class = NOTION_DATABASE_FIELD_CLASSES[property_types[property_name]]
+            # Create a database field with the details filed out
+            if database_field_class.SUPPORTS_MULTIPLE_VALUES:
+                database_field = database_field_class(values)
+            else:
+                if len(values) > 1:
+                    logger.warning(f"Multiple values ({values}) found for property {property_name}, which only supports one value. Using the last one.")
+                database_field = database_field_class(values[-1])
+            properties[property_name] = database_field.__dict__()
+        page_children = []
+        # Add banner saying this page is auto-generated if set
+        if self.include_information_banner:
+            page_children.append(
+                NotionPageQuoteBlock(
+                    "🤖 This page was automatically created by NotesTionSync."
+                ).__dict__()
+            )
+        page_children.append(NotionPageParagraphBlock("You can find the file at the link below:").__dict__())
+        return PageTemplate(properties, page_children)
+
+    def get_template(self, notion_tags:List[dict])->PageTemplate:
+        """Gets the page template for a list of tags, compiling it if it has not been compiled yet.
+
+        :param notion_tags: A list of Notion tags to add."""
+        template_key = self.get_template_key(notion_tags)
+        template = self.templates.get(template_key, None)
+        if template is None:
+            template = self.templates[template_key] = self.compile_template(notion_tags)
+        return template
+
+    def format_page(self, file_title:str, google_drive_file_id:str, file_link:str, notion_tags:List[dict])->Tuple[dict,List[dict]]:
+        """Renders the properties and content of a new page for a file.
+
+        :param file_title: The file title on Google Drive.
+
+        :param google_drive_file_id: The file ID on Google Drive.
+
+        :param file_link: A link to the file on Google Drive.
+
+        :param notion_tags: A list of Notion tags to add.
+
+        :returns A tuple of the rendered page properties and the rendered page children."""
+        template = self.get_template(notion_tags)
+        # Only fill out what differs between files. The template's rendered data is shared, so it must not be changed.
+        properties = dict(template.properties)
+        properties[self.document_name_field_name] = NotionTitleDatabaseField(file_title).__dict__()
+        properties[self.google_drive_id_field_name] = NotionRichTextDatabaseField(google_drive_file_id).__dict__()
+        page_children = list(template.page_children)
+        # Add document information: a link to the file in the new page
+        if self.embed_document_inline:
+            page_children.append(NotionPageURLBlock(file_link).__dict__())
+        else:
+            page_children.append(NotionPageEmbedBlock(file_link).__dict__())
+        return properties, page_children
@@ -0,0 +1,169 @@
+"""planner.py
+Computes what a sync would do without doing it: which files would be moved where and which Notion pages would be
+created. Nothing is downloaded, moved or created, and no local files are written (the journal is only read).
+Useful before big backfills or changes to the tag file. Like a sync, the plan includes files that an earlier run did
+not complete, and only the reverse-check folders that are assigned to this worker.
+Folders are listed concurrently, and the plan includes an estimate of the number of API calls and how long the
+sync would take at Notion's rate limit."""
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+from utilities import get_logger
+from concurrency import DEFAULT_MAX_LIMIT
+from google_drive.authorization import DriveAPIHandler
+from notion_api.rate_limiter import DEFAULT_REQUESTS_PER_SECOND
+from sync import SyncContext, SyncProfile
+from tag_detector import get_tag_detector
+
+logger = get_logger(__name__)
+
+# Like the fields used when syncing, but with the size to estimate how much would be downloaded
+PLAN_FILE_LIST_FIELDS = "nextPageToken, files(id, name, size)"
+# Google Drive returns at most this many files per listing request
+FILES_PER_LIST_REQUEST = 1000
+
+class SyncPlanner:
+    def __init__(self, profiles:List[SyncProfile], context:SyncContext, max_workers:int=DEFAULT_MAX_LIMIT):
+        """Initializes a sync planner.
+
+        :param profiles: The profiles to plan the sync of.
+
+        :param context: Provides the seen files, the journal, which folders are assigned to this worker and the
+        (authorized) Google Drive API handlers. The journal should be read-only, see journal.py.
+
+        :param max_workers: The most folders to list at the same time. How many requests are actually in flight is
+        adapted to how Google Drive is doing, see concurrency.py."""
+        self.profiles = profiles
+        self.context = context
+        self.max_workers = max_workers
+
+    def list_folder(self, drive:DriveAPIHandler, profile:SyncProfile, folder_id:str)->List[dict]:
+        """Lists the files that a sync would process in a folder. Runs in a worker thread.
+
+        :param drive: The Google Drive API handler for the profile.
+
+        :param profile: The profile that the folder belongs to.
+
+        :param folder_id: The ID of the folder on Google Drive."""
+        return drive.for_current_thread().list_all_files_in_directory(folder_id, fields=PLAN_FILE_LIST_FIELDS,
+                                                                      mime_types=profile.google_drive_mime_types,
+                                                                      include_folders=False)
+
+    def list_folders(self)->Dict[Tuple[str,str],List[dict]]:
+        """Lists the upload folders and the reverse-check folders assigned to this worker of every profile concurrently.
+
+        :returns A mapping of (profile name, folder ID) to the files in the folder."""
+        listings = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for profile in self.profiles:
+                drive = self.context.get_drive_handler(profile.google_drive_token_file)
+                folder_ids = [profile.google_drive_upload_folder_id] + [folder_id for folder_id in get_tag_detector(profile.tags_filepath).reverse_check_folder_ids
+                                                                        if self.context.is_folder_assigned(folder_id)]
+                for folder_id in folder_ids:
+                    listings[(profile.name, folder_id)] = executor.submit(self.list_folder, drive, profile, folder_id)
+        return {key: listing.result() for key, listing in listings.items()}
+
+    def plan(self)->dict:
+        """Computes the plan.
+
+        :returns The plan, in a format that can be dumped as JSON."""
+        logger.info("Listing folders...")
+        listings = self.list_folders()
+        seen_files = set(self.context.seen_files)
+        profile_plans = []
+        number_of_bytes_to_download = 0
+        number_of_list_requests = 0
+        for profile in self.profiles:
+            tag_detector = get_tag_detector(profile.tags_filepath)
+            moves = []
+            pages = []
+            resumes = []
+            planned_file_ids = set()
+            # Files that an earlier run did not complete are resumed first, and skipped when they are listed
+            for journal_entry in self.context.journal.get_unfinished(profile.name):
+                resumes.append({
+                    "file_google_drive_id": journal_entry["file_id"],
+                    "filename": journal_entry["file"]["name"],
+                    "after_step": journal_entry["state"],
+                    "to_folder_id": journal_entry["target_folder_id"]
+                })
+                if journal_entry["state"] == "listed" and journal_entry["source_folder_id"] is not None:
+                    moves.append({
+                        "file_google_drive_id": journal_entry["file_id"],
+                        "filename": journal_entry["file"]["name"],
+                        "from_folder_id": journal_entry["source_folder_id"],
+                        "to_folder_id": journal_entry["target_folder_id"]
+                    })
+                if journal_entry["state"] in ["listed", "moved"]:
+                    pages.append(self.get_planned_page(profile, journal_entry["file"], journal_entry["file_title"],
+                                                       journal_entry["notion_tags"], "resume"))
+                planned_file_ids.add(journal_entry["file_id"])
+            upload_folder_files = listings[(profile.name, profile.google_drive_upload_folder_id)]
+            for file in upload_folder_files:
+                if file["id"] in planned_file_ids or self.context.journal.is_failed(file["id"]):
+                    continue
+                target_google_drive_directory, notion_tags, file_title = tag_detector.get_drive_folder_from_filename(file["name"])
+                moves.append({
+                    "file_google_drive_id": file["id"],
+                    "filename": file["name"],
+                    "from_folder_id": profile.google_drive_upload_folder_id,
+                    "to_folder_id": target_google_drive_directory
+                })
+                pages.append(self.get_planned_page(profile, file, file_title, notion_tags, "upload_folder"))
+                planned_file_ids.add(file["id"])
+            # Files in the reverse-check folders that have not been seen would be linked too
+            for folder_id, folder_tags in tag_detector.reverse_check_folder_ids.items():
+                if (profile.name, folder_id) not in listings: # (assigned to another worker)
+                    continue
+                for file in listings[(profile.name, folder_id)]:
+                    if file["id"] in seen_files or file["id"] in planned_file_ids or self.context.journal.is_failed(file["id"]):
+                        continue
+                    target_google_drive_directory, notion_tags, file_title = tag_detector.get_drive_folder_from_filename(file["name"], folder_tags)
+                    pages.append(self.get_planned_page(profile, file, file_title, notion_tags, "reverse_check"))
+                    planned_file_ids.add(file["id"])
+            for (profile_name, folder_id), folder_files in listings.items():
+                if profile_name == profile.name:
+                    number_of_list_requests += max(1, math.ceil(len(folder_files) / FILES_PER_LIST_REQUEST))
+            number_of_bytes_to_download += sum(page["size"] for page in pages)
+            profile_plans.append({
+                "name": profile.name,
+                "resumes": resumes,
+                "moves": moves,
+                "pages": pages
+            })
+        number_of_moves = sum(len(profile_plan["moves"]) for profile_plan in profile_plans)
+        number_of_pages = sum(len(profile_plan["pages"]) for profile_plan in profile_plans)
+        # Page contents are small enough to be sent together with the page, so each page is one request
+        number_of_notion_requests = number_of_pages
+        return {
+            "profiles": profile_plans,
+            "estimate": {
+                "google_drive_list_requests": number_of_list_requests,
+                "google_drive_downloads": number_of_pages,
+                "google_drive_download_bytes": number_of_bytes_to_download,
+                "google_drive_moves": number_of_moves,
+                "notion_requests": number_of_notion_requests,
+                "minimum_duration_seconds": round(number_of_notion_requests / DEFAULT_REQUESTS_PER_SECOND, 1)
+            }
+        }
+
+    def get_planned_page(self, profile:SyncProfile, file:dict, file_title:str, notion_tags:List[dict], source:str)->dict:
+        """Describes a Notion page that would be created.
+
+        :param profile: The profile that the file belongs to.
+
+        :param file: Data for the file as a response dict returned by the Google API (or as recorded in the journal).
+
+        :param file_title: The title of the file without tags.
+
+        :param notion_tags: The Notion tags that would be applied.
+
+        :param source: Why the page would be created: "upload_folder", "reverse_check" or "resume"."""
+        return {
+            "file_google_drive_id": file["id"],
+            "file_title": file_title,
+            "notion_database_id": profile.notion_database_id,
+            "notion_tags": notion_tags,
+            "size": int(file.get("size", 0)),
+            "source": source
+        }
@@ -0,0 +1,83 @@
+"""file_view.py
+Gives post-sync modules a shared, read-only, memory-mapped view of a downloaded file.
+Instead of every module reading a (possibly very large) scan into memory, the file is mapped once and the same
+mapping is handed to every module that asks for it. Also includes helpers for cheap PDF metadata."""
+from __future__ import annotations
+
+import mmap
+import os
+import re
+from typing import Dict, Optional
+from utilities import get_logger
+
+logger = get_logger(__name__)
+
+PDF_PAGE_REGEX = re.compile(rb"/Type\s*/Page(?![A-Za-z])")
+PDF_THUMBNAIL_REFERENCE_REGEX = re.compile(rb"/Thumb\s+(\d+)\s+(\d+)\s+R")
+PDF_STREAM_START_REGEX = re.compile(rb"stream\r?\n")
+
+class MappedFile:
+    def __init__(self, path:str):
+        """Maps a file into memory, read-only.
+
+        :param path: The path to the file."""
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.file = open(path, "rb")
+        # Empty files can not be memory-mapped
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else None
+
+    @property
+    def data(self)->bytes|mmap.mmap:
+        """The content of the file. Supports slicing, find() and regular expressions without copying the whole file."""
+        return self.mmap if self.mmap is not None else b""
+
+    def get_page_count(self)->int:
+        """Counts the pages of a PDF file by counting its page objects.
+
+        :returns The number of pages in the file. Might be inaccurate for files with compressed object streams."""
+        return sum(1 for _ in PDF_PAGE_REGEX.finditer(self.data))
+
+    def get_first_page_thumbnail(self)->Optional[bytes]:
+        """Gets the thumbnail image embedded for the first page of a PDF file, if any.
+        Note that many PDF files do not include thumbnails.
+
+        :returns The raw (possibly compressed) image stream of the thumbnail, or None if it was not found."""
+        thumbnail_reference = PDF_THUMBNAIL_REFERENCE_REGEX.search(self.data)
+        if thumbnail_reference is None:
+            return None
+        object_number, generation_number = thumbnail_reference.groups()
+        thumbnail_object = re.search(rb"(?<!\d)" + object_number + rb"\s+" + generation_number + rb"\s+obj", self.data)
+        if thumbnail_object is None:
+            return None
+        stream_start = PDF_STREAM_START_REGEX.search(self.data, thumbnail_object.end())
+        if stream_start is None:
+            return None
+        stream_end = self.data.find(b"endstream", stream_start.end())
+        if stream_end == -1:
+            return None
+        return bytes(self.data[stream_start.end():stream_end]).rstrip(b"\r\n")
+
+    def close(self)->None:
+        """Unmaps and closes the file."""
+        if self.mmap is not None:
+            self.mmap.close()
+        self.file.close()
+
+# Shared mappings: file path --> mapped file
+file_views:Dict[str, MappedFile] = {}
+
+def get_file_view(path:str)->MappedFile:
+    """Gets the shared memory-mapped view of a file, mapping it if it has not been mapped yet.
+
+    :param path: The path to the file."""
+    if path not in file_views:
+        logger.debug(f"Memory-mapping file {path}...")
+        file_views[path] = MappedFile(path)
+    return file_views[path]
+
+def close_file_views()->None:
+    """Closes all shared memory-mapped views. Should be called when post-sync has completed."""
+    for file_view in file_views.values():
+        file_view.close()
+    file_views.clear()
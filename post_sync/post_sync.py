@@ -2,6 +2,7 @@
 Defines an example class for creating post syncs."""
 from typing import List, Optional
 from utilities import get_logger, get_config
+from .file_view import MappedFile, get_file_view
 
 # Create exception to identify errors in post-syncs
 class PostSyncException(Exception):
@@ -48,6 +49,12 @@ class PostSync:
             if not all([config_attribute in self.module_config for config_attribute in required_config_attributes]):
                 raise KeyError(f"Missing configuration keys for the post-sync module {self.module_name}. Required keys are {required_config_attributes}.")
 
+    @property
+    def file_view(self)->MappedFile:
+        """A read-only, memory-mapped view of the downloaded file, shared with the other post-sync modules.
+        Use this rather than reading the file at file_temporary_path into memory."""
+        return get_file_view(self.file_temporary_path)
+
     def run(self)->None:
         """Runs the post sync action. Override me!"""
         # Do things here
\ No newline at end of file
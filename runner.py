@@ -0,0 +1,274 @@
+"""runner.py
+Runs the syncing code: syncs, push mode and plans. See main.py for the command line interface."""
+import json
+import os.path
+import time
+from datetime import datetime
+from utilities import WORKING_DIR, TEMPORARY_FILES_DIR, get_logger, get_config, get_seen_files, clean_temporary_files
+from concurrency import DEFAULT_MAX_LIMIT
+from google_drive.downloads import DEFAULT_CHUNK_SIZE
+from google_drive.file_cache import FileCache
+from google_drive.push_notifications import DriveChangeWatcher, NotificationReceiver
+from text_extraction import TextExtractor
+from locking import WorkClaimer, LOCK_BACKENDS
+from journal import SyncJournal
+from sync import SyncContext, get_sync_profiles, run_sync_profiles
+from planner import SyncPlanner
+from tag_detector import get_tag_detector
+from post_sync import POST_SYNC_ACTIONS
+from post_sync.file_view import close_file_views
+from typing import List, Optional, Set, Tuple
+
+# Get a logger
+logger = get_logger(__name__)
+
+def create_sync_context(config:dict)->SyncContext:
+    """Creates the state and API clients shared between sync profiles from the configuration.
+
+    :param config: The configuration, see utilities.get_config()."""
+    google_drive_config = config["google_drive"]
+    download_chunk_size = google_drive_config.get("download_chunk_size", DEFAULT_CHUNK_SIZE) # (optional setting)
+    # Load optional file cache settings
+    file_cache_config = config.get("file_cache", {})
+    file_cache = None
+    if file_cache_config.get("enabled", False):
+        file_cache = FileCache(file_cache_config.get("directory", os.path.join(TEMPORARY_FILES_DIR, "cache")),
+                               file_cache_config.get("max_size_mb", 1024) * 1024 * 1024)
+    # Load optional text extraction settings
+    text_extraction_config = config.get("text_extraction", {})
+    text_extractor = None
+    if text_extraction_config.get("enabled", False):
+        text_extractor = TextExtractor(text_extraction_config.get("max_workers", None), # (defaults to the number of CPU cores)
+                                       text_extraction_config.get("max_characters", None))
+    # Load optional locking settings
+    locking_config = config.get("locking", {})
+    work_claimer = None
+    if locking_config.get("enabled", True):
+        lock_backend = LOCK_BACKENDS[locking_config.get("backend", "file")](os.path.join(WORKING_DIR, locking_config.get("path", ".notion_drive_sync_locks")))
+        work_claimer = WorkClaimer(lock_backend, locking_config.get("lease_seconds", 3600))
+    worker_index, worker_count = get_worker_shard(config)
+    return SyncContext(get_seen_files(), download_chunk_size=download_chunk_size, file_cache=file_cache,
+                       text_extractor=text_extractor, work_claimer=work_claimer, max_requests_in_flight=get_max_requests_in_flight(config),
+                       worker_index=worker_index, worker_count=worker_count)
+
+def get_worker_shard(config:dict)->Tuple[int,int]:
+    """Gets which share of the reverse-check folders this worker checks, see locking.py. Only used if locking is enabled.
+
+    :param config: The configuration, see utilities.get_config().
+
+    :returns A tuple of the index of this worker and the total number of workers."""
+    locking_config = config.get("locking", {})
+    if not locking_config.get("enabled", True):
+        return 0, 1
+    return locking_config.get("worker_index", 0), locking_config.get("worker_count", 1) # (optional settings)
+
+def get_max_requests_in_flight(config:dict)->int:
+    """Gets the most requests that may be in flight at once to each API account. See concurrency.py.
+
+    :param config: The configuration, see utilities.get_config()."""
+    return config.get("concurrency", {}).get("max_requests_in_flight", DEFAULT_MAX_LIMIT) # (optional setting)
+
+def log_concurrency_metrics(sync_context:SyncContext)->None:
+    """Logs the current concurrency limits, which are adapted to how the APIs are doing.
+
+    :param sync_context: The state and API clients shared between sync profiles."""
+    for metrics in sync_context.get_concurrency_metrics():
+        logger.info(f"Concurrency for {metrics['name']}: limit {metrics['limit']}, {metrics['requests']} requests "
+                    f"({metrics['overloaded_requests']} overloaded, {metrics['backoffs']} backoffs).")
+        for request_type, latency in metrics["latency_ms"].items():
+            logger.debug(f"Average latency of {request_type} requests to {metrics['name']}: {latency['average']} ms "
+                         f"(usually {latency['baseline']} ms).")
+
+def run_post_sync(config:dict, seen_files_data:List[dict])->None:
+    """Runs the enabled post-sync modules for synced files.
+
+    :param config: The configuration, see utilities.get_config().
+
+    :param seen_files_data: Details for every synced file, see SyncContext.mark_file_as_seen()."""
+    post_sync_config = config["post_sync"] if "post_sync" in config else None
+    if post_sync_config is not None and post_sync_config["enabled"]:
+        logger.info("Running post-sync...")
+        # Get all the enabled post-sync modules
+        post_sync_modules = post_sync_config["enabled_modules"]
+        for enabled_post_sync_module in post_sync_modules: # For every enabled module
+            if enabled_post_sync_module not in POST_SYNC_ACTIONS: # Validate module name
+                logger.critical(f"The post sync module {enabled_post_sync_module} is not supported. Supported modules are: {list(POST_SYNC_ACTIONS.keys())}.")
+                continue
+            for seen_file in seen_files_data: # For every updated file
+                post_sync_object = POST_SYNC_ACTIONS[enabled_post_sync_module](**seen_file)
+                post_sync_object.run()
+                logger.debug(f"Post-sync for file {seen_file['file_title']} completed.")
+        close_file_views() # (files have to be unmapped before they can be removed below)
+        logger.info("Post-sync completed.")
+    else:
+        logger.info("No post-sync to be ran.")
+
+def run_sync(sync_context:SyncContext, backfill:bool=False, modified_after:Optional[datetime]=None)->None:
+    """Runs one sync of all sync profiles, including post-sync.
+
+    :param sync_context: The state and API clients shared between sync profiles. Can be reused between syncs.
+
+    :param backfill: If True, only do the reverse check, to link files that were added to the folders directly.
+
+    :param modified_after: If set, only reverse-check files modified after this time."""
+    config = get_config() # (only re-read if it has changed)
+    sync_profiles = get_sync_profiles(config)
+    # Clean up any temporary paths left over from an earlier run.
+    # Partial downloads are kept so that they can be resumed.
+    temporary_files_removed = clean_temporary_files()
+
+    if temporary_files_removed > 0:
+        logger.info(f"Found {temporary_files_removed} temporary files to remove.")
+    else:
+        logger.debug("No temporary files to remove.")
+    sync_context.start_run("backfill" if backfill else "sync")
+    logger.info(f"Syncing {len(sync_profiles)} sync profiles... ✨")
+    try:
+        run_sync_profiles(sync_profiles, sync_context, backfill, modified_after)
+        if sync_context.text_extractor is not None:
+            logger.info("Waiting for text extraction to finish...")
+            sync_context.add_extracted_text_to_notion()
+        logger.info("Notion sync completed. Running post-sync if enabled...")
+        sync_context.renew_claims(force=True) # (so that no other run resumes the files while post-sync is running)
+        run_post_sync(config, sync_context.seen_files_data)
+        sync_context.mark_files_as_notified()
+    except Exception as e:
+        sync_context.finish_run(e)
+        raise
+    finally:
+        # Release claims on files, including ones that were not completed so that other runs can pick them up right away
+        if sync_context.work_claimer is not None:
+            sync_context.work_claimer.release_all()
+    completed_files_removed = sync_context.journal.compact()
+    logger.debug(f"Removed {completed_files_removed} completed files from the journal.")
+    log_concurrency_metrics(sync_context)
+    sync_context.finish_run()
+    # Downloaded files are only needed by post-sync, so they can be removed now
+    temporary_files_removed = clean_temporary_files()
+    logger.debug(f"Removed {temporary_files_removed} temporary files.")
+    # Evicting is done after post-sync so that no file that is still needed is evicted
+    if sync_context.file_cache is not None:
+        sync_context.file_cache.evict()
+
+def get_synced_folder_ids(config:dict, sync_context:SyncContext, watcher:DriveChangeWatcher)->Set[str]:
+    """Gets the IDs of the folders that a sync looks at (upload folders and reverse-check folders) in the Google account
+    of a watcher.
+
+    :param config: The configuration, see utilities.get_config().
+
+    :param sync_context: The state and API clients shared between sync profiles.
+
+    :param watcher: The watcher for the Google account."""
+    folder_ids = set()
+    for profile in get_sync_profiles(config):
+        if sync_context.get_drive_handler(profile.google_drive_token_file) is watcher.drive:
+            folder_ids.add(profile.google_drive_upload_folder_id)
+            folder_ids.update(get_tag_detector(profile.tags_filepath).reverse_check_folder_ids.keys())
+    return folder_ids
+
+def has_relevant_changes(sync_context:SyncContext, watchers:List[DriveChangeWatcher])->bool:
+    """Lists the changes that the watchers have been notified about and checks if any of them are in a folder that
+    a sync looks at. Changes to other files in the Google accounts (for example someone editing a document) are ignored.
+
+    :param sync_context: The state and API clients shared between sync profiles.
+
+    :param watchers: The watchers of every Google account that is synced."""
+    config = get_config() # (the folders might have changed)
+    relevant_changes = False
+    for watcher in watchers: # (list the changes of every watcher, so that they all continue from the latest change next time)
+        changed_parent_ids = watcher.get_changed_parent_ids()
+        if len(changed_parent_ids & get_synced_folder_ids(config, sync_context, watcher)) > 0:
+            relevant_changes = True
+    return relevant_changes
+
+def run_push_mode(config:dict, sync_context:SyncContext)->None:
+    """Keeps running and syncs whenever Google Drive notifies about changes, with polling as a fallback.
+    See google_drive/push_notifications.py.
+
+    :param config: The configuration, see utilities.get_config().
+
+    :param sync_context: The state and API clients shared between sync profiles."""
+    push_config = config["push_notifications"]
+    fallback_poll_interval = push_config.get("fallback_poll_interval_seconds", 900)
+    renew_margin = push_config.get("renew_margin_seconds", 600)
+    debounce_seconds = push_config.get("debounce_seconds", 10)
+    receiver = NotificationReceiver(push_config.get("host", "0.0.0.0"), push_config.get("port", 8080), push_config.get("token", None))
+    # Watch changes for every Google account that is synced
+    watchers = []
+    for profile in get_sync_profiles(config):
+        drive = sync_context.get_drive_handler(profile.google_drive_token_file)
+        if not any(watcher.drive is drive for watcher in watchers):
+            watchers.append(DriveChangeWatcher(drive, push_config["address"], push_config.get("token", None),
+                                               push_config.get("channel_ttl_seconds", 86400)))
+    receiver.start()
+    try:
+        for watcher in watchers:
+            watcher.start()
+        run_sync(sync_context) # (catch up on anything that happened while not running)
+        last_sync = time.monotonic()
+        while True:
+            # Wait for a notification, but not longer than until the next fallback poll or channel renewal
+            seconds_to_next_poll = fallback_poll_interval - (time.monotonic() - last_sync)
+            seconds_to_next_renewal = min(watcher.get_seconds_until_renewal(renew_margin) for watcher in watchers)
+            notified = receiver.wait(max(0, min(seconds_to_next_poll, seconds_to_next_renewal)))
+            for watcher in watchers:
+                watcher.renew_if_needed(renew_margin)
+            if notified:
+                # Changes often come in bursts (for example when uploading many files), so wait a bit to sync them all at once
+                time.sleep(debounce_seconds)
+                receiver.clear()
+                if not has_relevant_changes(sync_context, watchers):
+                    logger.debug("Received change notification, but nothing changed in the synced folders.")
+                    continue
+                logger.info("Received change notification for a synced folder. Syncing...")
+            elif time.monotonic() - last_sync >= fallback_poll_interval:
+                logger.info("No notifications received for a while. Syncing in case any were missed...")
+            else:
+                continue
+            run_sync(sync_context)
+            last_sync = time.monotonic()
+    finally:
+        for watcher in watchers:
+            watcher.stop()
+        receiver.stop()
+
+def run_plan(config:dict, output_filepath:Optional[str]=None)->None:
+    """Computes what a sync would do without doing it and outputs it as JSON. See planner.py.
+
+    :param config: The configuration, see utilities.get_config().
+
+    :param output_filepath: If set, write the plan to this file instead of printing it."""
+    # Only the seen files, the journal, the sharding and the Google Drive API handlers of the context are used.
+    # Planning must not change anything, so the journal is only read.
+    max_requests_in_flight = get_max_requests_in_flight(config)
+    worker_index, worker_count = get_worker_shard(config)
+    sync_context = SyncContext(get_seen_files(), journal=SyncJournal(read_only=True), max_requests_in_flight=max_requests_in_flight,
+                               worker_index=worker_index, worker_count=worker_count)
+    planner = SyncPlanner(get_sync_profiles(config), sync_context, max_workers=max_requests_in_flight)
+    plan = json.dumps(planner.plan(), indent=2, ensure_ascii=False)
+    log_concurrency_metrics(sync_context)
+    if output_filepath is not None:
+        with open(output_filepath, "w", encoding="UTF-8") as output_file:
+            output_file.write(plan)
+        logger.info(f"Plan written to {output_filepath}.")
+    else:
+        print(plan)
+
+def run(config:dict, backfill:bool=False, modified_after:Optional[datetime]=None)->None:
+    """Runs a single sync, or keeps syncing in push mode if it is enabled.
+
+    :param config: The configuration, see utilities.get_config().
+
+    :param backfill: If True, run a single backfill instead, see run_sync().
+
+    :param modified_after: For backfills: if set, only reverse-check files modified after this time."""
+    sync_context = create_sync_context(config)
+    try:
+        if not backfill and config.get("push_notifications", {}).get("enabled", False):
+            run_push_mode(config, sync_context)
+        else:
+            run_sync(sync_context, backfill, modified_after)
+    finally:
+        if sync_context.text_extractor is not None:
+            sync_context.text_extractor.shutdown()
+    logger.info("Program completed.")
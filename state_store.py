@@ -0,0 +1,221 @@
+"""state_store.py
+Keeps a history of what has been synced: a record for every file that was synced (or failed to sync) and for every
+run. This makes it possible to find out where a file went, which runs failed and how much has been synced over time
+without asking Google Drive or Notion, see the status command in main.py.
+
+Records are appended to a file as JSON arrays (one per line) rather than objects, which keeps the file compact, and are
+loaded into classes with __slots__ so that large histories do not take up much memory. The file is only read when
+the history is queried."""
+import bisect
+import fcntl
+import json
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from utilities import STATE_FILEPATH, get_logger, append_line
+
+logger = get_logger(__name__)
+
+class FileRecord:
+    __slots__ = ("file_id", "profile", "title", "status", "synced_at", "run_id", "notion_page_id", "notion_page_url", "error")
+
+    def __init__(self, file_id:str, profile:str, title:str, status:str, synced_at:float, run_id:str,
+                 notion_page_id:Optional[str]=None, notion_page_url:Optional[str]=None, error:Optional[str]=None):
+        """A record of a file being synced.
+
+        :param file_id: The ID of the file on Google Drive.
+
+        :param profile: The name of the sync profile that the file was synced by.
+
+        :param title: The title of the file.
+
+        :param status: "synced" if the file was linked to Notion, or "failed".
+
+        :param synced_at: When the file was synced, as a UNIX timestamp.
+
+        :param run_id: The ID of the run that the file was synced by.
+
+        :param notion_page_id: The ID of the Notion page for the file, if one was created.
+
+        :param notion_page_url: A link to the Notion page for the file, if one was created.
+
+        :param error: For failed files, what went wrong."""
+        self.file_id = file_id
+        self.profile = profile
+        self.title = title
+        self.status = status
+        self.synced_at = synced_at
+        self.run_id = run_id
+        self.notion_page_id = notion_page_id
+        self.notion_page_url = notion_page_url
+        self.error = error
+
+class RunRecord:
+    __slots__ = ("run_id", "command", "started_at", "duration_seconds", "files_synced", "files_failed", "status", "error")
+
+    def __init__(self, run_id:str, command:str, started_at:float, duration_seconds:float, files_synced:int, files_failed:int,
+                 status:str, error:Optional[str]=None):
+        """A record of a run.
+
+        :param run_id: A unique ID of the run.
+
+        :param command: Which command the run was started by: "sync" or "backfill".
+
+        :param started_at: When the run started, as a UNIX timestamp.
+
+        :param duration_seconds: How long the run took.
+
+        :param files_synced: How many files were synced.
+
+        :param files_failed: How many files failed to sync.
+
+        :param status: "completed" if the run completed, or "failed" if it was stopped by an error.
+
+        :param error: For failed runs, what went wrong."""
+        self.run_id = run_id
+        self.command = command
+        self.started_at = started_at
+        self.duration_seconds = duration_seconds
+        self.files_synced = files_synced
+        self.files_failed = files_failed
+        self.status = status
+        self.error = error
+
+# Record types as stored in the file: the first value of each line says which type the rest of the line is
+RECORD_TYPES = {"file": FileRecord, "run": RunRecord}
+
+class StateStore:
+    def __init__(self, filepath:str=STATE_FILEPATH):
+        """Initializes the state store. The file is not read until the history is queried.
+
+        :param filepath: The path to the file to store records in. Created when the first record is added."""
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.files:List[FileRecord] = [] # (sorted by synced_at)
+        self.file_sync_times:List[float] = [] # (synced_at of every record in files, for bisecting)
+        self.files_by_id:Dict[str,FileRecord] = {} # (latest record for each file)
+        self.files_by_notion_page:Dict[str,FileRecord] = {} # (by page ID without dashes)
+        self.runs:List[RunRecord] = [] # (sorted by started_at)
+        self.run_start_times:List[float] = [] # (started_at of every record in runs, for bisecting)
+
+    def load(self)->None:
+        """(Re-)reads all records from the file and indexes them."""
+        with self.lock:
+            self.files, self.file_sync_times, self.runs, self.run_start_times = [], [], [], []
+            self.files_by_id, self.files_by_notion_page = {}, {}
+            try:
+                with open(self.filepath, encoding="UTF-8") as state_file:
+                    for line in state_file:
+                        try:
+                            record_type, *values = json.loads(line)
+                            self.index_record(RECORD_TYPES[record_type](*values))
+                        except (ValueError, KeyError, TypeError): # (for example a line that was cut off by a crash)
+                            logger.warning(f"Ignoring invalid line in the state file: {line!r}")
+            except FileNotFoundError:
+                pass
+            self.loaded = True
+
+    def ensure_loaded(self)->None:
+        """Reads the records from the file if that has not been done yet."""
+        if not self.loaded:
+            self.load()
+
+    def index_record(self, record)->None:
+        """Adds a record to the indexes. Must be called with the lock held.
+
+        :param record: A FileRecord or RunRecord."""
+        # Records are almost always added in order, so inserting is usually appending
+        if isinstance(record, RunRecord):
+            index = bisect.bisect_right(self.run_start_times, record.started_at)
+            self.run_start_times.insert(index, record.started_at)
+            self.runs.insert(index, record)
+            return
+        index = bisect.bisect_right(self.file_sync_times, record.synced_at)
+        self.file_sync_times.insert(index, record.synced_at)
+        self.files.insert(index, record)
+        latest_record = self.files_by_id.get(record.file_id, None)
+        if latest_record is None or latest_record.synced_at <= record.synced_at:
+            self.files_by_id[record.file_id] = record
+        if record.notion_page_id is not None:
+            self.files_by_notion_page[record.notion_page_id.replace("-", "")] = record
+
+    def add(self, record)->None:
+        """Adds a record and writes it to the file.
+
+        :param record: A FileRecord or RunRecord."""
+        record_type = "file" if isinstance(record, FileRecord) else "run"
+        line = json.dumps([record_type] + [getattr(record, slot) for slot in record.__slots__], ensure_ascii=False)
+        with self.lock:
+            with open(self.filepath + ".lock", "a") as lock_file: # (other runs might append at the same time)
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                append_line(self.filepath, line)
+            if self.loaded:
+                self.index_record(record)
+
+    def get_file(self, file_id:str)->Optional[FileRecord]:
+        """Gets the latest record for a file.
+
+        :param file_id: The ID of the file on Google Drive."""
+        self.ensure_loaded()
+        return self.files_by_id.get(file_id, None)
+
+    def get_file_by_notion_page(self, notion_page_id:str)->Optional[FileRecord]:
+        """Gets the record of the file that a Notion page was created for.
+
+        :param notion_page_id: The ID of the Notion page, with or without dashes."""
+        self.ensure_loaded()
+        return self.files_by_notion_page.get(notion_page_id.replace("-", ""), None)
+
+    def get_files_synced_between(self, start_time:float, end_time:float)->List[FileRecord]:
+        """Gets the records of files synced in a time range.
+
+        :param start_time: The start of the range (inclusive), as a UNIX timestamp.
+
+        :param end_time: The end of the range (exclusive), as a UNIX timestamp."""
+        self.ensure_loaded()
+        return self.files[bisect.bisect_left(self.file_sync_times, start_time):bisect.bisect_left(self.file_sync_times, end_time)]
+
+    def get_failures(self, limit:int=10)->List[FileRecord]:
+        """Gets the latest files that failed to sync and have not been synced since.
+
+        :param limit: The most records to return.
+
+        :returns The records, the most recent first."""
+        self.ensure_loaded()
+        failures = []
+        for record in reversed(self.files):
+            if len(failures) >= limit:
+                break
+            if record.status == "failed" and self.files_by_id[record.file_id] is record:
+                failures.append(record)
+        return failures
+
+    def get_recent_runs(self, limit:int=10)->List[RunRecord]:
+        """Gets the latest runs.
+
+        :param limit: The most records to return.
+
+        :returns The records, the most recent first."""
+        self.ensure_loaded()
+        return self.runs[::-1][:limit]
+
+    def get_throughput(self, days:int=7, bucket_seconds:float=86400)->List[Tuple[float,int]]:
+        """Gets how many files have been synced over time.
+
+        :param days: How many days back to go.
+
+        :param bucket_seconds: How long each period to count files in is. Defaults to a day.
+
+        :returns A list of (start of period as a UNIX timestamp, number of files synced in the period), oldest first."""
+        self.ensure_loaded()
+        end_time = time.time()
+        start_time = end_time - days * 86400
+        throughput = []
+        bucket_start = start_time
+        while bucket_start < end_time:
+            bucket_end = min(bucket_start + bucket_seconds, end_time)
+            throughput.append((bucket_start, sum(1 for record in self.get_files_synced_between(bucket_start, bucket_end)
+                                                 if record.status == "synced")))
+            bucket_start = bucket_end
+        return throughput
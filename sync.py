@@ -0,0 +1,590 @@
+"""sync.py
+Contains the syncing code for sync profiles.
+A sync profile is one upload folder with its tag file and the Notion database that its files are linked in.
+Multiple profiles can run from the same process: they share API clients (and therefore connection pools and rate
+limiters) through a SyncContext, and are scheduled fairly so that one large upload folder does not hold up the others."""
+import os.path
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Generator, List, Optional, Tuple
+import requests
+from utilities import WORKING_DIR, TEMPORARY_FILES_DIR, TAGS_FILEPATH, SYNC_PROFILE_GOOGLE_DRIVE_KEYS, get_logger, get_seen_files, add_seen_file, validate_tags
+from concurrency import AdaptiveConcurrencyLimiter, DEFAULT_MAX_LIMIT
+from journal import SyncJournal, MAX_RESUME_ATTEMPTS
+from locking import WorkClaimer, is_assigned_to_worker
+from state_store import StateStore, FileRecord, RunRecord
+from notion_api.notion import NotionAPIClient
+from notion_api.rate_limiter import RateLimiter
+from page_formatter import PageFormatter
+from google_drive.authorization import DriveAPIHandler
+from google_drive.downloads import DriveFileDownloader, DEFAULT_CHUNK_SIZE
+from google_drive.file_cache import FileCache
+from tag_detector import get_tag_detector
+from text_extraction import TextExtractor, get_paragraph_blocks
+
+logger = get_logger(__name__)
+
+class SyncProfile:
+    def __init__(self, name:str, notion_config:dict, google_drive_config:dict, tags_filepath:str):
+        """Defines a sync profile.
+
+        :param name: The name of the profile. Used in logging.
+
+        :param notion_config: The Notion settings for the profile (same format as the notion section of the config).
+
+        :param google_drive_config: The Google Drive settings for the profile (same format as the google_drive
+        section of the config).
+
+        :param tags_filepath: The path to the tag file of the profile."""
+        self.name = name
+        self.notion_auth_token = notion_config["auth_token"]
+        self.notion_database_id = notion_config["upload_database_id"]
+        self.notion_document_name_field_name = notion_config["document_name_field_name"]
+        self.notion_google_drive_id_field_name = notion_config["google_drive_id_field_name"]
+        self.notion_tag_types = notion_config["tag_types"]
+        # Load optional Notion settings
+        self.notion_new_page_icon = notion_config.get("new_page_icon", None) # (icon is optional)
+        self.notion_new_page_information_banner = notion_config.get("include_information_banner", True) # (optional setting)
+        self.notion_new_page_embed_document_inline = notion_config.get("embed_document_inline", True) # (optional setting)
+        self.google_drive_upload_folder_id = google_drive_config["upload_folder_id"]
+        self.google_drive_mime_types = google_drive_config.get("mime_types", ["application/pdf"]) # (optional setting)
+        self.google_drive_token_file = os.path.join(WORKING_DIR, google_drive_config["token_file"])
+        self.tags_filepath = tags_filepath
+
+def get_sync_profiles(config:dict)->List[SyncProfile]:
+    """Gets the sync profiles from the configuration.
+    If no profiles are configured under sync_profiles, a single profile is created from the notion and google_drive
+    sections of the configuration.
+
+    :param config: The configuration, see utilities.get_config()."""
+    if "sync_profiles" not in config:
+        return [SyncProfile("default", config["notion"], config["google_drive"], TAGS_FILEPATH)]
+    sync_profiles = []
+    for profile_config in config["sync_profiles"]:
+        # Settings that are not set in the profile are taken from the main sections of the config
+        notion_config = dict(config["notion"])
+        notion_config.update({key: value for key, value in profile_config.items() if key in notion_config or key in ["new_page_icon", "include_information_banner", "embed_document_inline"]})
+        google_drive_config = dict(config["google_drive"])
+        google_drive_config.update({key: value for key, value in profile_config.items() if key in SYNC_PROFILE_GOOGLE_DRIVE_KEYS})
+        tags_filepath = os.path.join(WORKING_DIR, profile_config["tags_file"]) if "tags_file" in profile_config else TAGS_FILEPATH
+        sync_profiles.append(SyncProfile(profile_config["name"], notion_config, google_drive_config, tags_filepath))
+    return sync_profiles
+
+class SyncContext:
+    def __init__(self, seen_files:List[str], download_chunk_size:int=DEFAULT_CHUNK_SIZE, file_cache:Optional[FileCache]=None,
+                 text_extractor:Optional[TextExtractor]=None, work_claimer:Optional[WorkClaimer]=None,
+                 journal:Optional[SyncJournal]=None, max_requests_in_flight:int=DEFAULT_MAX_LIMIT, state_store:Optional[StateStore]=None,
+                 worker_index:int=0, worker_count:int=1):
+        """Holds the state and API clients that are shared between sync profiles.
+
+        :param seen_files: IDs of files that have been seen.
+
+        :param download_chunk_size: How many bytes to download at a time.
+
+        :param file_cache: If set, a file cache to download files through.
+
+        :param text_extractor: If set, a text extractor to extract text from downloaded files with.
+
+        :param work_claimer: If set, files are claimed before they are processed so that concurrent runs do not
+        process the same files.
+
+        :param journal: The journal to record the steps taken for each file in. If not set, the default journal
+        file is used.
+
+        :param max_requests_in_flight: The most requests that may be in flight at once to each Notion integration and
+        Google account. The actual limit is adapted to how the APIs are doing, see concurrency.py.
+
+        :param state_store: Where to keep the history of synced files and runs. If not set, the default state file
+        is used.
+
+        :param worker_index: The index of this worker (starting at 0), when reverse-check folders are sharded between workers.
+
+        :param worker_count: The total number of workers that reverse-check folders are sharded between."""
+        self.seen_files = seen_files
+        self.seen_files_data:List[dict] = []
+        self.download_chunk_size = download_chunk_size
+        self.file_cache = file_cache
+        self.text_extractor = text_extractor
+        self.work_claimer = work_claimer
+        self.journal = journal if journal is not None else SyncJournal()
+        self.max_requests_in_flight = max_requests_in_flight
+        self.state_store = state_store if state_store is not None else StateStore()
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+        self.run_id:Optional[str] = None
+        self.run_command = "sync"
+        self.run_started_at = 0.0
+        self.number_of_files_synced = self.number_of_files_failed = 0
+        self.text_extraction_futures:List[Tuple[NotionAPIClient,str,Future]] = []
+        # All Notion clients share one connection pool. Notion rate limits per integration, so clients with the
+        # same token share a rate limiter and concurrency limiter.
+        self.notion_session = requests.Session()
+        self.notion_clients:Dict[str, NotionAPIClient] = {}
+        self.drive_handlers:Dict[str, DriveAPIHandler] = {}
+        self.downloaders:Dict[str, DriveFileDownloader] = {}
+
+    def start_run(self, command:str="sync")->None:
+        """Prepares the context for a new sync. Needed when the context is reused between syncs.
+
+        :param command: Which command started the sync: "sync" or "backfill". Stored in the history of runs."""
+        self.seen_files = get_seen_files() # (other runs might have added files)
+        self.seen_files_data = []
+        self.journal.load()
+        self.run_id = uuid.uuid4().hex
+        self.run_command = command
+        self.run_started_at = time.time()
+        self.number_of_files_synced = self.number_of_files_failed = 0
+
+    def finish_run(self, error:Optional[Exception]=None)->None:
+        """Adds the sync to the history of runs, see state_store.py.
+
+        :param error: If the sync was stopped by an error, the error."""
+        self.state_store.add(RunRecord(self.run_id, self.run_command, round(self.run_started_at, 3), round(time.time() - self.run_started_at, 3),
+                                       self.number_of_files_synced, self.number_of_files_failed,
+                                       "failed" if error is not None else "completed", str(error) if error is not None else None))
+
+    def add_file_to_history(self, profile_name:str, journal_entry:dict, error:Optional[Exception]=None)->None:
+        """Adds a file that was synced (or failed to sync) to the history, see state_store.py.
+
+        :param profile_name: The name of the profile that synced the file.
+
+        :param journal_entry: The journal entry for the file, see journal.py.
+
+        :param error: If syncing the file failed, the error."""
+        if error is not None:
+            self.number_of_files_failed += 1
+        else:
+            self.number_of_files_synced += 1
+        self.state_store.add(FileRecord(journal_entry["file_id"], profile_name, journal_entry["file_title"],
+                                        "failed" if error is not None else "synced", round(time.time(), 3), self.run_id,
+                                        journal_entry.get("notion_page_id", None), journal_entry.get("notion_link", None),
+                                        str(error) if error is not None else None))
+
+    def get_notion_client(self, auth_token:str)->NotionAPIClient:
+        """Gets the shared Notion API client for a token, creating it if needed.
+
+        :param auth_token: The Notion auth token."""
+        if auth_token not in self.notion_clients:
+            concurrency_limiter = AdaptiveConcurrencyLimiter(f"notion:{len(self.notion_clients)}", max_limit=self.max_requests_in_flight) # (not named by the token, which is secret)
+            self.notion_clients[auth_token] = NotionAPIClient(auth_token, rate_limiter=RateLimiter(), session=self.notion_session,
+                                                              concurrency_limiter=concurrency_limiter)
+        return self.notion_clients[auth_token]
+
+    def get_drive_handler(self, token_file:str)->DriveAPIHandler:
+        """Gets the shared (authorized) Google Drive API handler for a Google account, creating it if needed.
+
+        :param token_file: The token file of the Google account."""
+        if token_file not in self.drive_handlers:
+            drive = DriveAPIHandler(token_file, AdaptiveConcurrencyLimiter(f"google_drive:{os.path.basename(token_file)}",
+                                                                           max_limit=self.max_requests_in_flight))
+            drive.authorize() # Ensure authorization
+            self.drive_handlers[token_file] = drive
+        return self.drive_handlers[token_file]
+
+    def get_downloader(self, token_file:str)->DriveFileDownloader:
+        """Gets the shared downloader for a Google account, creating it if needed.
+
+        :param token_file: The token file of the Google account."""
+        if token_file not in self.downloaders:
+            drive = self.get_drive_handler(token_file)
+            self.downloaders[token_file] = DriveFileDownloader(drive.credentials, TEMPORARY_FILES_DIR, chunk_size=self.download_chunk_size,
+                                                               cache=self.file_cache, concurrency_limiter=drive.concurrency_limiter)
+        return self.downloaders[token_file]
+
+    def get_concurrency_metrics(self)->List[dict]:
+        """Gets the current concurrency limits and request statistics for every Notion integration and Google account.
+        See AdaptiveConcurrencyLimiter.get_metrics()."""
+        return [client.concurrency_limiter.get_metrics() for client in list(self.notion_clients.values()) + list(self.drive_handlers.values())]
+
+    def mark_file_as_seen(self, file_id:str, file_title:str, file_temporary_path:str, file_link:str, notion_link:str, notion_tags:List[dict])->None:
+        """Marks a file as seen and saves its details for post-sync."""
+        if file_id not in self.seen_files: # (a resumed file might have been marked as seen before a crash)
+            self.seen_files.append(file_id)
+            add_seen_file(file_id) # Update seen files
+        self.seen_files_data.append({
+            "file_google_drive_id": file_id,
+            "file_title": file_title,
+            "file_temporary_path": file_temporary_path,
+            "file_google_drive_link": file_link,
+            "notion_new_page_link": notion_link,
+            "notion_tags": notion_tags
+        })
+
+    def mark_files_as_notified(self)->None:
+        """Records in the journal that post-sync has been run for all files synced in this run, which completes them."""
+        for seen_file in self.seen_files_data:
+            self.journal.record(seen_file["file_google_drive_id"], "notified")
+
+    def claim_file(self, file_id:str, resuming:bool=False)->bool:
+        """Claims a file before it is processed. See locking.py.
+        Claims are held (and renewed, see renew_claims()) until the end of the run, so that no other run resumes a
+        file before post-sync has been run for it.
+
+        :param file_id: The ID of the file on Google Drive.
+
+        :param resuming: True if the file is resumed from the journal. Resumed files might already be marked as seen.
+
+        :returns True if the file should be processed, False if another run has processed it or is processing it."""
+        if self.work_claimer is None:
+            return True
+        if not self.work_claimer.claim(file_id):
+            return False
+        # Another run might have finished processing the file since it was listed. Runs on other hosts have their own
+        # seen files and journal, so files that they have completed are only known to the lock backend.
+        if not resuming:
+            processed_by_another_run = file_id in get_seen_files() or self.work_claimer.is_completed(file_id)
+        else:
+            self.journal.load()
+            # A file resumed after its page was created was completed by this host, which still has to run post-sync for it
+            processed_by_another_run = not self.journal.is_unfinished(file_id) or \
+                                       (self.journal.get(file_id)["state"] != "page_created" and self.work_claimer.is_completed(file_id))
+            if processed_by_another_run and self.journal.is_unfinished(file_id):
+                self.journal.record(file_id, "notified") # (post-sync has been run by the other run, so this completes the file here)
+        if processed_by_another_run:
+            logger.info(f"File {file_id} was processed by another run. Skipping it.")
+            self.work_claimer.release(file_id)
+            return False
+        return True
+
+    def mark_file_as_completed(self, file_id:str)->None:
+        """Marks a file as completed for all runs once its Notion page has been created, see locking.py.
+
+        :param file_id: The ID of the file on Google Drive."""
+        if self.work_claimer is not None:
+            self.work_claimer.mark_completed(file_id)
+
+    def renew_claims(self, force:bool=False)->None:
+        """Renews the claims on files, so that they do not expire while the run is still going. See WorkClaimer.renew_all().
+
+        :param force: If True, renew the claims regardless of when they were last renewed."""
+        if self.work_claimer is not None:
+            self.work_claimer.renew_all(force)
+
+    def is_folder_assigned(self, folder_id:str)->bool:
+        """Checks if a folder should be reverse-checked by this worker.
+
+        :param folder_id: The ID of the folder on Google Drive."""
+        return is_assigned_to_worker(folder_id, self.worker_index, self.worker_count)
+
+    def add_extracted_text_to_notion(self)->None:
+        """Waits for all text extraction to finish and adds the extracted text to the Notion pages.
+        Text is added to multiple pages at the same time: how many requests are actually in flight is adapted to
+        how Notion is doing, see concurrency.py."""
+        with ThreadPoolExecutor(max_workers=self.max_requests_in_flight) as executor:
+            appends = [executor.submit(self.add_page_text_to_notion, notion, notion_page_id, text_extraction_future)
+                       for notion, notion_page_id, text_extraction_future in self.text_extraction_futures]
+            for append in appends:
+                append.result()
+        self.text_extraction_futures.clear()
+
+    def add_page_text_to_notion(self, notion:NotionAPIClient, notion_page_id:str, text_extraction_future:Future)->None:
+        """Waits for text extraction to finish for a page and adds the extracted text to it. Runs in a worker thread.
+        The blocks of a page are appended one batch after another, to keep them in order.
+
+        :param notion: The Notion API client for the page.
+
+        :param notion_page_id: The ID of the Notion page.
+
+        :param text_extraction_future: The future of the text extraction, see TextExtractor.submit()."""
+        try:
+            page_texts = text_extraction_future.result()
+        except Exception as e:
+            logger.warning(f"Failed to extract text for Notion page {notion_page_id}: {e}", exc_info=True)
+            return
+        if len(page_texts) == 0:
+            logger.debug(f"No text found for Notion page {notion_page_id}.")
+            return
+        logger.info(f"Adding extracted text to Notion page {notion_page_id}...")
+        notion.append_block_children(notion_page_id, get_paragraph_blocks(page_texts))
+
+class ProfileSyncer:
+    def __init__(self, profile:SyncProfile, context:SyncContext):
+        """Initializes the syncing of a sync profile.
+
+        :param profile: The profile to sync.
+
+        :param context: The shared state and API clients."""
+        self.profile = profile
+        self.context = context
+        self.notion = context.get_notion_client(profile.notion_auth_token)
+        self.drive = context.get_drive_handler(profile.google_drive_token_file)
+        self.downloader = context.get_downloader(profile.google_drive_token_file)
+        # Create a page formatter for new Notion pages
+        self.page_formatter = PageFormatter(profile.notion_document_name_field_name, profile.notion_google_drive_id_field_name,
+                                            profile.notion_tag_types,
+                                            include_information_banner=profile.notion_new_page_information_banner,
+                                            embed_document_inline=profile.notion_new_page_embed_document_inline)
+        # Get a tag detector (shared, and only recreated when the tag file changes)
+        self.tag_detector = get_tag_detector(profile.tags_filepath)
+        validate_tags(self.tag_detector.tag_mappings, profile.notion_tag_types) # (the profile might have its own tag types)
+        self.logger = get_logger(f"{__name__}.{profile.name}")
+
+    def record_file(self, file_object:dict, source_folder_id:Optional[str], apply_tags:Optional[List[dict]]=None)->dict:
+        """Retrieves all the file details that we need for linking the file and records them in the journal.
+
+        :param file_object: Data for the file as a response dict returned by the Google API.
+
+        :param source_folder_id: The folder to move the file from, or None if the file should not be moved.
+
+        :param apply_tags: If set, a list of tags to apply to the file regardless.
+
+        :returns The journal entry for the file, see journal.py."""
+        # Get data for the file
+        filename = file_object["name"]
+        file_id = file_object["id"]
+        self.logger.info(f"Processing file {file_id} ({filename})...")
+        # Get which directory to put it in
+        target_google_drive_directory, notion_tags, file_title = self.tag_detector.get_drive_folder_from_filename(filename, apply_tags)
+        self.logger.info(
+            f"Found directory and tags for file {filename} ({file_id}): {target_google_drive_directory} and {notion_tags}.")
+        return self.context.journal.record(file_id, "listed", profile=self.profile.name,
+                                           file={key: value for key, value in file_object.items() if key in ["id", "name", "md5Checksum", "version"]},
+                                           source_folder_id=source_folder_id, target_folder_id=target_google_drive_directory,
+                                           file_title=file_title, notion_tags=notion_tags)
+
+    def process_file(self, journal_entry:dict)->None:
+        """Processes a file, continuing after the last step that has been completed for it, and adds it to the history.
+
+        :param journal_entry: The journal entry for the file, see journal.py."""
+        try:
+            journal_entry = self.process_file_steps(journal_entry)
+        except Exception as e:
+            self.context.add_file_to_history(self.profile.name, self.context.journal.get(journal_entry["file_id"]), e)
+            raise
+        self.context.add_file_to_history(self.profile.name, journal_entry)
+
+    def process_file_steps(self, journal_entry:dict)->dict:
+        """Does the steps of processing a file that have not been completed yet. See process_file().
+
+        :param journal_entry: The journal entry for the file, see journal.py.
+
+        :returns The updated journal entry."""
+        file_id = journal_entry["file_id"]
+        # Only files resumed after being moved can already have a Notion page, see below
+        page_might_exist = journal_entry["state"] == "moved"
+        # Download file
+        # Even though Notion doesn't support it, the implementation of post-checks (see README.md)
+        # hands over the temporary file so Notion can do stuff with it.
+        file_temporary_path = self.downloader.download(journal_entry["file"])
+        if journal_entry["state"] == "listed":
+            if journal_entry["source_folder_id"] is not None: # (files found in the reverse check are already in place)
+                # Move file to the directory it should be moved to
+                self.logger.info("Moving file...")
+                moving_response = self.drive.execute(self.drive.api_client.files().update(fileId=file_id, addParents=journal_entry["target_folder_id"],
+                                                                                          removeParents=journal_entry["source_folder_id"]))
+                self.logger.debug(f"The file was moved with response {moving_response}")
+            journal_entry = self.context.journal.record(file_id, "moved")
+        if journal_entry["state"] == "moved":
+            # Now, link the file to Notion. If an earlier run crashed after creating the page but before recording it,
+            # the page already exists.
+            existing_page = self.find_notion_page(file_id) if page_might_exist else None
+            if existing_page is not None:
+                self.logger.info(f"Found an existing Notion page for file {file_id} at {existing_page['url']}. Not creating another one.")
+                file_link, notion_link, notion_page_id = f"https://drive.google.com/file/d/{file_id}/view", existing_page["url"], existing_page["id"]
+            else:
+                file_link, notion_link, notion_page_id = self.link_file_to_notion(file_id, journal_entry["file_title"], journal_entry["notion_tags"])
+            journal_entry = self.context.journal.record(file_id, "page_created", file_link=file_link, notion_link=notion_link,
+                                                        notion_page_id=notion_page_id)
+            self.context.mark_file_as_completed(file_id)
+            self.extract_text(notion_page_id, file_temporary_path)
+        self.context.mark_file_as_seen(file_id, journal_entry["file_title"], file_temporary_path, journal_entry["file_link"],
+                                       journal_entry["notion_link"], journal_entry["notion_tags"])
+        return journal_entry
+
+    def link_file_to_notion(self, google_drive_file_id, file_title, notion_tags)->Tuple[str,str,str]:
+        """Links a Google Drive file in Notion by creating a Notion page.
+
+        :param google_drive_file_id: The file ID on Google Drive.
+
+        :param file_title: The file title on Google Drive.
+
+        :param notion_tags: A list of Notion tags to add.
+
+        :returns A tuple consisting of: A link to the file on Google Drive, a link to the new Notion page, and the ID
+        of the new Notion page."""
+        file_link = f"https://drive.google.com/file/d/{google_drive_file_id}/view"
+        self.logger.info(f"Google Drive link for {file_title} is {file_link}.")
+        self.logger.info(f"Starting linking for {file_link} with Notion...")
+        # Create a new page for the file
+        new_page_parent = {"database_id": self.profile.notion_database_id}
+        # Fill out the page. Everything except the title, the Google Drive ID and the link is rendered once per tag path.
+        new_page_properties, page_children = self.page_formatter.format_page(file_title, google_drive_file_id, file_link, notion_tags)
+        self.logger.debug(f"Properties for new page are: {new_page_properties}.")
+        self.logger.info("Creating new page on Notion...")
+        new_page = self.notion.create_page_from_data(
+            new_page_parent,
+            new_page_properties,
+            page_children=page_children, # Add everything to fill out the page with
+            icon=self.profile.notion_new_page_icon
+        )
+        notion_link = new_page["url"]
+        self.logger.info(f"New Notion page created at: {notion_link}.")
+        return file_link, notion_link, new_page["id"]
+
+    def find_notion_page(self, google_drive_file_id:str)->Optional[dict]:
+        """Finds the Notion page that has been created for a file, if there is any.
+
+        :param google_drive_file_id: The file ID on Google Drive.
+
+        :returns The page as a response dict returned by the Notion API, or None if no page has been created for the file."""
+        pages = self.notion.query_database(self.profile.notion_database_id, {
+            "property": self.profile.notion_google_drive_id_field_name,
+            "rich_text": {"equals": google_drive_file_id}
+        }, page_size=1)
+        return pages[0] if len(pages) > 0 else None
+
+    def extract_text(self, notion_page_id:str, file_temporary_path:str)->None:
+        """Starts extracting text from a file in the background if text extraction is enabled.
+        The text is added to the Notion page once the sync has completed, see SyncContext.add_extracted_text_to_notion().
+
+        :param notion_page_id: The ID of the Notion page to add the text to.
+
+        :param file_temporary_path: The path to the downloaded file."""
+        if self.context.text_extractor is not None:
+            self.context.text_extraction_futures.append((self.notion, notion_page_id, self.context.text_extractor.submit(file_temporary_path)))
+
+    def list_files(self, folder_id:str, modified_after:Optional[datetime]=None, drive:Optional[DriveAPIHandler]=None)->List[dict]:
+        """Lists the files to process in a folder: files with a supported MIME type that are not trashed.
+
+        :param folder_id: The ID of the folder on Google Drive.
+
+        :param modified_after: If set, only list files modified after this time.
+
+        :param drive: The Google Drive API handler to list the files with. Defaults to the handler of the profile,
+        which may only be used from the main thread."""
+        drive = drive if drive is not None else self.drive
+        return drive.list_all_files_in_directory(folder_id, mime_types=self.profile.google_drive_mime_types,
+                                                 include_folders=False, modified_after=modified_after)
+
+    def list_folders(self, folder_ids:List[str], modified_after:Optional[datetime]=None)->Dict[str,List[dict]]:
+        """Lists the files to process in multiple folders at the same time. How many requests are actually in flight
+        is adapted to how Google Drive is doing, see concurrency.py.
+
+        :param folder_ids: The IDs of the folders on Google Drive.
+
+        :param modified_after: If set, only list files modified after this time.
+
+        :returns A mapping of folder ID to the files in the folder."""
+        with ThreadPoolExecutor(max_workers=self.context.max_requests_in_flight) as executor:
+            listings = {folder_id: executor.submit(lambda folder_id=folder_id: self.list_files(folder_id, modified_after, self.drive.for_current_thread()))
+                        for folder_id in folder_ids}
+            return {folder_id: listing.result() for folder_id, listing in listings.items()}
+
+    def sync(self, backfill:bool=False, modified_after:Optional[datetime]=None)->Generator[None, None, None]:
+        """Syncs the profile. This is a generator which yields after each processed file, so that multiple profiles
+        can take turns, see run_sync_profiles().
+
+        :param backfill: If True, only do the reverse check (and resume unfinished files), not the upload folder.
+
+        :param modified_after: If set, only reverse-check files modified after this time."""
+        # First, resume files that an earlier run did not complete (for example because it crashed)
+        yield from self.resume_files()
+        if not backfill:
+            yield from self.sync_upload_folder()
+        yield from self.reverse_check(modified_after)
+
+    def resume_files(self)->Generator[None, None, None]:
+        """Resumes files that an earlier run did not complete, see journal.py. Files that still can not be completed
+        after MAX_RESUME_ATTEMPTS attempts are marked as failed. Yields after each file."""
+        for journal_entry in self.context.journal.get_unfinished(self.profile.name):
+            file_id = journal_entry["file_id"]
+            if not self.context.claim_file(file_id, resuming=True):
+                continue
+            journal_entry = self.context.journal.get(file_id) # (the entry might have been updated by another run)
+            attempt = journal_entry.get("resume_attempts", 0) + 1
+            self.logger.info(f"Resuming file {file_id} ({journal_entry['file']['name']}) after step {journal_entry['state']} "
+                             f"(attempt {attempt} of {MAX_RESUME_ATTEMPTS})...")
+            # Record the attempt first, so that it counts even if the script crashes
+            journal_entry = self.context.journal.record(file_id, journal_entry["state"], resume_attempts=attempt)
+            try:
+                self.process_file(journal_entry)
+            except Exception as e: # (for example if the file has been deleted since. Do not let it block the rest of the sync.)
+                if attempt < MAX_RESUME_ATTEMPTS:
+                    self.logger.error(f"Failed to resume file {file_id}: {e}. It will be retried on the next run.", exc_info=True)
+                else:
+                    self.context.journal.record(file_id, "failed", failed_after_state=self.context.journal.get(file_id)["state"], error=str(e))
+                    self.logger.error(f"Failed to resume file {file_id}: {e}. Giving up after {attempt} attempts. "
+                                      f"Run python3 main.py retry to retry it.", exc_info=True)
+            yield
+
+    def sync_upload_folder(self)->Generator[None, None, None]:
+        """Moves the files in the upload folder and links them to Notion. Yields after each file."""
+        # List files in the Google Drive directory
+        files = self.list_files(self.profile.google_drive_upload_folder_id)
+        number_of_files = len(files)
+        self.logger.info("Received {} {} to process...".format(
+            number_of_files,
+            'file' if number_of_files == 1 else 'files'
+        ))
+        for file in files:
+            if self.context.journal.is_unfinished(file["id"]):
+                self.logger.debug(f"Ignoring file {file['id']} (was resumed or is being processed by another run)")
+                continue
+            elif self.context.journal.is_failed(file["id"]):
+                self.logger.debug(f"Ignoring file {file['id']} (failed to sync, see python3 main.py status)")
+                continue
+            elif not self.context.claim_file(file["id"]):
+                continue
+            self.process_file(self.record_file(file, self.profile.google_drive_upload_folder_id))
+            yield
+
+    def reverse_check(self, modified_after:Optional[datetime]=None)->Generator[None, None, None]:
+        """Links files in the folders that files are moved to which have not been seen. Yields after each file.
+
+        :param modified_after: If set, only check files modified after this time."""
+        # Next, we do a reverse check. It's a chance someone moved documents directly
+        # to the folders instead to the "incoming scan" folders.
+        # Therefore, we scan all the files in the folders that the script is configured
+        # to move files to and if we discover anything new, we add it to Notion.
+        reverse_check_folder_ids = {folder_id: folder_tags for folder_id, folder_tags in self.tag_detector.reverse_check_folder_ids.items()
+                                    if self.context.is_folder_assigned(folder_id)}
+        self.logger.debug(f"Reverse-checking the following folders: {reverse_check_folder_ids.keys()} "
+                          f"(other folders are assigned to other workers)")
+        # List all directories at once, then process their files one at a time
+        listings = self.list_folders(list(reverse_check_folder_ids.keys()), modified_after)
+        for folder_id, folder_tags in reverse_check_folder_ids.items():
+            self.logger.info(f"Reverse-checking folder {folder_id}...")
+            for folder_subfile in listings[folder_id]:
+                if folder_subfile["id"] in self.context.seen_files:
+                    self.logger.debug(f"Ignoring file {folder_subfile['id']} (is already seen)")
+                    continue
+                elif self.context.journal.is_unfinished(folder_subfile["id"]): # (for example moved, but not linked yet)
+                    self.logger.debug(f"Ignoring file {folder_subfile['id']} (was resumed or is being processed by another run)")
+                    continue
+                elif self.context.journal.is_failed(folder_subfile["id"]):
+                    self.logger.debug(f"Ignoring file {folder_subfile['id']} (failed to sync, see python3 main.py status)")
+                    continue
+                elif not self.context.claim_file(folder_subfile["id"]):
+                    continue
+                self.logger.info(f"Found a non-seen file: {folder_subfile['id']}. Linking to Notion...")
+                self.process_file(self.record_file(folder_subfile, None, folder_tags))
+                self.logger.info("Unseen file linked to Notion.")
+                yield
+
+def run_sync_profiles(profiles:List[SyncProfile], context:SyncContext, backfill:bool=False, modified_after:Optional[datetime]=None)->None:
+    """Syncs multiple profiles. The profiles take turns processing one file at a time (round-robin), so that
+    every profile makes progress even if another one has a lot of files to process.
+
+    :param profiles: The profiles to sync.
+
+    :param context: The shared state and API clients.
+
+    :param backfill: If True, only do the reverse check. See ProfileSyncer.sync().
+
+    :param modified_after: If set, only reverse-check files modified after this time."""
+    running_syncs = deque()
+    for profile in profiles:
+        logger.info(f"Starting sync of profile {profile.name}...")
+        running_syncs.append((profile, ProfileSyncer(profile, context).sync(backfill, modified_after)))
+    while len(running_syncs) > 0:
+        profile, running_sync = running_syncs.popleft()
+        context.renew_claims() # (processing many files can take longer than a lease)
+        try:
+            next(running_sync)
+        except StopIteration:
+            logger.info(f"Sync of profile {profile.name} completed.")
+            continue
+        running_syncs.append((profile, running_sync))
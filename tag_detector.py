@@ -6,8 +6,8 @@ ma. --> okay, it has something to do with maths
     u. --> okay, it is assignment work
     g. --> okay, it is lecture notes
 tag_detector creates a detector for this."""
-from utilities import get_logger
-from typing import Optional, Tuple, List
+from utilities import TAGS_FILEPATH, get_logger, get_tags
+from typing import Dict, Optional, Tuple, List
 import os
 
 class TagDetector:
@@ -17,6 +17,21 @@ class TagDetector:
         :param tag_mappings: A configuration file which is a dictionary supporting multiple recursion levels."""
         self.tag_mappings = tag_mappings
         self.logger = get_logger(__name__)
+        # Compiled once, see get_reverse_check_folder_ids()
+        self.reverse_check_folder_ids = self.get_reverse_check_folder_ids(self.tag_mappings)
+
+    def get_reverse_check_folder_ids(self, tags:dict)->Dict[str,List[dict]]:
+        """Reverses the mapping file (tags.json5) for the reverse check (see sync.py).
+
+        :returns A mapping of folder IDs the tags belonging to that move folder ID."""
+        folder_ids_to_tags = {}
+        for tag_id, tag_data in tags.items():
+            # Detect tag type: has subtags or not subtags.
+            if "folder_id" in tag_data:
+                folder_ids_to_tags[tag_data["folder_id"]] = tag_data["notion_tags"]
+            else: # Recursively apply the function
+                folder_ids_to_tags.update(self.get_reverse_check_folder_ids(tag_data))
+        return folder_ids_to_tags
 
     def get_tags(self, string:str, current_recursion_level:Optional[dict]=None)->Optional[dict]:
         """Gets the Google Drive folder for the tag in a string formatted according to the tag format (XX.YY.ZZ).
@@ -86,7 +101,7 @@ class TagDetector:
             filename_without_tags = " ".join(filename_split[1:])
         # See if any tags are set to always be applied
         if apply_tags is not None:
-            found_tag_notion_tags = apply_tags
+            found_tag_notion_tags = list(apply_tags) # (copy, since the tag mapping is shared and must not be changed)
         else:
             found_tag_notion_tags = []
         found_tag_notion_tags.extend(found_tag["notion_tags"])
@@ -99,3 +114,17 @@ class TagDetector:
         found_tag_drive_folder = found_tag["folder_id"]
         self.logger.info(f"Found target folder: {found_tag_drive_folder}, Notion tags {found_tag_notion_tags} for filename {filename}.")
         return found_tag_drive_folder, found_tag_notion_tags, filename_without_tags
+
+# Tag detectors for each tag file: file path --> tag detector
+tag_detectors:Dict[str, TagDetector] = {}
+
+def get_tag_detector(tags_filepath:str=TAGS_FILEPATH)->TagDetector:
+    """Gets a tag detector for a tag file. The tag detector is only recreated when the tag file has changed,
+    and is replaced in one assignment so that a tag detector that is in use is never changed.
+
+    :param tags_filepath: The path to the tag file. Defaults to tags.json5 in the working directory."""
+    tag_mappings = get_tags(tags_filepath)
+    tag_detector = tag_detectors.get(tags_filepath, None)
+    if tag_detector is None or tag_detector.tag_mappings is not tag_mappings: # (get_tags() returns a new dict when the file has changed)
+        tag_detector = tag_detectors[tags_filepath] = TagDetector(tag_mappings)
+    return tag_detector
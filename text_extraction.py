@@ -0,0 +1,73 @@
+"""text_extraction.py
+Extracts the text layer from downloaded PDF files so that scans become searchable in Notion.
+Parsing large scans is CPU-heavy, so it is done in a process pool, letting it run on all cores while the
+syncing continues.
+Requires the optional pypdf library (pip install pypdf)."""
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import List, Optional
+from notion_api.page_blocks import NotionPageParagraphBlock
+from utilities import get_logger
+
+logger = get_logger(__name__)
+
+# Notion does not accept more than 2000 characters in a single text object
+MAX_CHARACTERS_PER_PARAGRAPH = 2000
+
+def extract_text_from_pdf(path:str, max_characters:Optional[int]=None)->List[str]:
+    """Extracts the text of each page in a PDF file. Runs in a worker process.
+
+    :param path: The path to the PDF file.
+
+    :param max_characters: If set, stop extracting text when this many characters have been extracted.
+
+    :returns A list with the text of each page that has a text layer."""
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    page_texts = []
+    total_characters = 0
+    for page in reader.pages:
+        page_text = (page.extract_text() or "").strip()
+        if len(page_text) == 0: # Page does not have a text layer
+            continue
+        if max_characters is not None and total_characters + len(page_text) > max_characters:
+            page_texts.append(page_text[:max_characters - total_characters])
+            break
+        page_texts.append(page_text)
+        total_characters += len(page_text)
+    return page_texts
+
+def get_paragraph_blocks(page_texts:List[str])->List[NotionPageParagraphBlock]:
+    """Converts extracted text into Notion paragraph blocks, splitting text that is too long for one paragraph.
+
+    :param page_texts: The text of each page, as returned by extract_text_from_pdf()."""
+    paragraph_blocks = []
+    for page_text in page_texts:
+        for paragraph_start in range(0, len(page_text), MAX_CHARACTERS_PER_PARAGRAPH):
+            paragraph_blocks.append(NotionPageParagraphBlock(page_text[paragraph_start:paragraph_start + MAX_CHARACTERS_PER_PARAGRAPH]))
+    return paragraph_blocks
+
+class TextExtractor:
+    def __init__(self, max_workers:Optional[int]=None, max_characters:Optional[int]=None):
+        """Initializes a text extractor with a pool of worker processes.
+
+        :param max_workers: The number of worker processes. Defaults to the number of CPU cores.
+
+        :param max_characters: If set, the maximum number of characters to extract from each file."""
+        if importlib.util.find_spec("pypdf") is None:
+            raise ImportError("Text extraction requires the pypdf library. Install it using pip install pypdf.")
+        self.max_characters = max_characters
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    def submit(self, path:str)->Future:
+        """Starts extracting text from a PDF file in the background.
+
+        :param path: The path to the PDF file.
+
+        :returns A future which results in the text of each page of the file."""
+        logger.debug(f"Submitting {path} for text extraction...")
+        return self.executor.submit(extract_text_from_pdf, path, self.max_characters)
+
+    def shutdown(self)->None:
+        """Shuts down the worker processes."""
+        self.executor.shutdown()
@@ -1,26 +1,168 @@
 """utilities.py
-Some utility functions and classes."""
-import os, toml, logging, json5
+Some utility functions and classes.
+Libraries that are only needed for some commands (toml, json5 and colorama) are imported when they are first used,
+so that commands that do not need them (like status) start quickly."""
+import os, logging, threading
 from logging import Formatter, LogRecord, DEBUG, INFO, WARNING, ERROR, CRITICAL, getLogger, StreamHandler, basicConfig
-from typing import List
-
-from colorama import Fore, Style
+from typing import Callable, Dict, List, Optional, Tuple
 
 # paths
 WORKING_DIR = os.getcwd()
 CONFIGURATION_FILEPATH = os.path.join(WORKING_DIR, "config.toml")
 TAGS_FILEPATH = os.path.join(WORKING_DIR, "tags.json5")
 SEEN_FILES_FILEPATH = os.path.join(WORKING_DIR, ".notion_drive_sync_seen")
+JOURNAL_FILEPATH = os.path.join(WORKING_DIR, ".notion_drive_sync_journal")
+STATE_FILEPATH = os.path.join(WORKING_DIR, ".notion_drive_sync_state")
 TEMPORARY_FILES_DIR = os.path.join(WORKING_DIR, "temporary_files")
+
+# Create exception to identify errors in the configuration
+class ConfigurationError(Exception):
+    pass
+
+class ParsedFile:
+    def __init__(self, filepath:str, parser:Callable[[str], dict], validator:Optional[Callable[[dict], None]]=None):
+        """A configuration file that is parsed and validated once, and then only again when it changes on disk.
+
+        :param filepath: The path to the file.
+
+        :param parser: A function that parses the content of the file.
+
+        :param validator: If set, a function that validates the parsed content, raising ConfigurationError
+        if it is invalid."""
+        self.filepath = filepath
+        self.parser = parser
+        self.validator = validator
+        self.cached:Optional[Tuple[Tuple[int,int], dict]] = None # (file version, parsed content)
+        self.lock = threading.Lock()
+
+    def get(self)->dict:
+        """Gets the parsed content of the file, reloading it if it has changed since it was last loaded.
+        If a changed file is invalid, the last valid content is kept (and an error is logged)."""
+        file_stat = os.stat(self.filepath)
+        file_version = (file_stat.st_mtime_ns, file_stat.st_size)
+        cached = self.cached
+        if cached is not None and cached[0] == file_version:
+            return cached[1]
+        with self.lock:
+            cached = self.cached
+            if cached is not None and cached[0] == file_version: # (reloaded while waiting for the lock)
+                return cached[1]
+            try:
+                with open(self.filepath, encoding="UTF-8") as file:
+                    content = self.parser(file.read())
+                if self.validator is not None:
+                    self.validator(content)
+            except Exception as e:
+                if cached is None:
+                    raise
+                logger.error(f"Failed to reload {self.filepath}: {e}. Keeping the previous version.")
+                return cached[1]
+            # Swap in the new content in one assignment, so that readers see either the old or the new content
+            self.cached = (file_version, content)
+        if cached is not None:
+            logger.info(f"Reloaded {self.filepath}.")
+        return content
+
+def parse_toml(content:str)->dict:
+    """Parses a TOML file (the configuration file)."""
+    import toml
+    return toml.loads(content)
+
+def parse_json5(content:str)->dict:
+    """Parses a JSON5 file (the tag file)."""
+    import json5
+    return json5.loads(content)
+
+# Keys that are required in the configuration file
+REQUIRED_CONFIG_KEYS = {
+    "notion": ["auth_token", "upload_database_id", "document_name_field_name", "google_drive_id_field_name", "tag_types"],
+    "google_drive": ["token_file", "credentials_file", "scopes", "upload_folder_id"]
+}
+# Keys that are required in each sync profile (other settings default to the notion and google_drive sections)
+REQUIRED_SYNC_PROFILE_KEYS = ["name", "upload_folder_id"]
+# Settings under google_drive that can be set per sync profile. The other ones are shared by all profiles.
+SYNC_PROFILE_GOOGLE_DRIVE_KEYS = ["upload_folder_id", "token_file", "mime_types"]
+
+def validate_config(config:dict)->None:
+    """Validates the configuration, raising ConfigurationError if it is invalid."""
+    from notion_api.database_fields import DATABASE_FIELDS
+    for section, required_keys in REQUIRED_CONFIG_KEYS.items():
+        if section not in config:
+            raise ConfigurationError(f"Missing section {section} in the configuration.")
+        for required_key in required_keys:
+            if required_key not in config[section]:
+                raise ConfigurationError(f"Missing configuration key {required_key} under {section}.")
+    sync_profile_names = set()
+    for index, profile_config in enumerate(config.get("sync_profiles", [])):
+        for required_key in REQUIRED_SYNC_PROFILE_KEYS:
+            if required_key not in profile_config:
+                raise ConfigurationError(f"Missing configuration key {required_key} in sync profile number {index + 1}.")
+        if profile_config["name"] in sync_profile_names:
+            raise ConfigurationError(f"There are multiple sync profiles named {profile_config['name']}.")
+        sync_profile_names.add(profile_config["name"])
+        for key in profile_config:
+            if key in config["google_drive"] and key not in SYNC_PROFILE_GOOGLE_DRIVE_KEYS:
+                raise ConfigurationError(f"The setting {key} in sync profile {profile_config['name']} can not be set per profile. "
+                                         f"Settings under google_drive that can be set per profile are: {SYNC_PROFILE_GOOGLE_DRIVE_KEYS}.")
+    for tag_types in get_all_tag_types(config):
+        for tag_type_id, tag_type in tag_types.items():
+            if "name" not in tag_type or "notion_type" not in tag_type:
+                raise ConfigurationError(f"The tag type {tag_type_id} must have a name and a notion_type.")
+            if tag_type["notion_type"] not in DATABASE_FIELDS:
+                raise ConfigurationError(f"The tag type {tag_type_id} has an unsupported notion_type: {tag_type['notion_type']}. Supported types are: {list(DATABASE_FIELDS.keys())}.")
+
+def get_all_tag_types(config:dict)->List[dict]:
+    """Gets the tag types set in the configuration, including any set in sync profiles."""
+    return [config["notion"]["tag_types"]] + [profile["tag_types"] for profile in config.get("sync_profiles", []) if "tag_types" in profile]
+
+def validate_tags(tags:dict, tag_types:dict, tag_path:str="")->None:
+    """Validates a tag mapping, raising ConfigurationError if it is invalid.
+
+    :param tags: The tag mapping (or a level of it).
+
+    :param tag_types: The tag types that may be referenced in the tag mapping.
+
+    :param tag_path: The path to the current level of the tag mapping. Used in error messages."""
+    if "folder_id" in tags: # Tag without subtags
+        for tag in tags.get("notion_tags", []):
+            if tag.get("type", None) not in tag_types:
+                raise ConfigurationError(f"The tag {tag_path} references the tag type {tag.get('type', None)}, which is not set under tag_types.")
+        return
+    if "fallback" not in tags:
+        raise ConfigurationError(f"The tag {tag_path or '(top level)'} must have either a folder_id or a fallback.")
+    if "folder_id" not in tags["fallback"]:
+        raise ConfigurationError(f"The fallback of the tag {tag_path or '(top level)'} must have a folder_id.")
+    for subtag, subtag_data in tags.items():
+        if not isinstance(subtag_data, dict):
+            raise ConfigurationError(f"The tag {tag_path}.{subtag} must be an object.")
+        validate_tags(subtag_data, tag_types, f"{tag_path}.{subtag}" if tag_path else subtag)
+
+def validate_tags_against_config(tags:dict)->None:
+    """Validates a tag mapping against the tag types in the configuration."""
+    all_tag_types = {}
+    for tag_types in get_all_tag_types(get_config()):
+        all_tag_types.update(tag_types)
+    validate_tags(tags, all_tag_types)
+
+configuration_file = ParsedFile(CONFIGURATION_FILEPATH, parse_toml, validate_config)
+# Tag files (there may be one for each sync profile): file path --> parsed file
+tag_files:Dict[str, ParsedFile] = {}
+
 def get_config()->dict:
-    """Gets the configuration and returns it."""
-    return toml.loads(open(CONFIGURATION_FILEPATH, encoding="UTF-8").read())
+    """Gets the configuration and returns it. The configuration is only re-read when the file changes.
+    The returned dictionary is shared, so it must not be changed."""
+    return configuration_file.get()
 
-def get_tags()->dict:
-    """Gets the content of the tag file.
+def get_tags(tags_filepath:str=TAGS_FILEPATH)->dict:
+    """Gets the content of the tag file. The tag file is only re-read when it changes.
+    The returned dictionary is shared, so it must not be changed.
+
+    :param tags_filepath: The path to the tag file. Defaults to tags.json5 in the working directory.
 
     :returns Content of the tag configuration file loadedas a dictionary."""
-    return json5.loads(open(TAGS_FILEPATH, encoding="UTF-8").read())
+    if tags_filepath not in tag_files:
+        tag_files[tags_filepath] = ParsedFile(tags_filepath, parse_json5, validate_tags_against_config)
+    return tag_files[tags_filepath].get()
 
 def get_seen_files()->List[str]:
     """Gets the content of the seen files filepath."""
@@ -32,17 +174,73 @@ def update_seen_files(file_paths_to_add:List[str])->None:
     with open(SEEN_FILES_FILEPATH, "w", encoding="UTF-8") as seen_files_file:
         seen_files_file.write("\n".join(file_paths_to_add))
 
+def add_seen_file(file_id:str)->None:
+    """Adds a file to the seen files. Unlike update_seen_files(), this appends to the file, so that seen files
+    added by other runs at the same time are not overwritten."""
+    with open(SEEN_FILES_FILEPATH, "a", encoding="UTF-8") as seen_files_file:
+        # (the file does not end with a newline, see update_seen_files())
+        seen_files_file.write(("\n" if seen_files_file.tell() > 0 else "") + file_id)
+
+def clean_temporary_files(keep_partial_files:bool=True)->int:
+    """Removes files from the temporary files directory.
+
+    :param keep_partial_files: If True, partially downloaded files (ending with .part) are kept so that their
+    downloads can be resumed.
+
+    :returns The number of files that were removed."""
+    temporary_files_removed = 0
+    for temporary_path in os.listdir(TEMPORARY_FILES_DIR):
+        full_temporary_path = os.path.join(TEMPORARY_FILES_DIR, temporary_path)
+        if not os.path.isfile(full_temporary_path) or (keep_partial_files and temporary_path.endswith(".part")):
+            continue
+        os.remove(full_temporary_path)
+        temporary_files_removed += 1
+    return temporary_files_removed
+
+def append_line(filepath:str, line:str, sync_to_disk:bool=False)->None:
+    """Appends a line to a file. If the last line in the file was cut off (for example by a crash while it was
+    written), the new line is still written on a line of its own.
+
+    :param filepath: The path to the file. Created if it does not exist.
+
+    :param line: The line to append, without a newline.
+
+    :param sync_to_disk: If True, only return once the line is on disk."""
+    with open(filepath, "ab+") as file:
+        if file.seek(0, os.SEEK_END) > 0:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b"\n":
+                file.write(b"\n")
+        file.write((line + "\n").encode("UTF-8"))
+        file.flush()
+        if sync_to_disk:
+            os.fsync(file.fileno())
+
+def fsync_directory(directory:str)->None:
+    """Flushes a directory entry to disk so that a rename into it survives a crash.
+    Not supported on all platforms, in which case nothing is done."""
+    try:
+        directory_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_fd)
+
 
 #  A logger with color output
 class ColorFormatter(Formatter):
     """A formatter for logging files that prints out different colors
     and nerdfont-compatible text depending on the status."""
-    COLORS = {
-        DEBUG: Fore.LIGHTBLACK_EX,
-        INFO: Fore.BLUE,
-        WARNING: Fore.YELLOW,
-        ERROR: Fore.LIGHTRED_EX,
-        CRITICAL: Fore.RED
+    COLORS = { # (names of colorama colors, which is only imported once something is logged)
+        DEBUG: "LIGHTBLACK_EX",
+        INFO: "BLUE",
+        WARNING: "YELLOW",
+        ERROR: "LIGHTRED_EX",
+        CRITICAL: "RED"
     }
     ICONS = {
         DEBUG: "",
@@ -51,24 +249,32 @@ class ColorFormatter(Formatter):
         ERROR: "",
         CRITICAL: ""
     }
-    LOG_FORMAT = f"{Fore.BLACK}%(asctime)s{Style.RESET_ALL}$COLOR[$ICON%(levelname)s]{Style.RESET_ALL} {Fore.BLACK}%(message)s{Style.RESET_ALL}"
+    LOG_FORMAT = "$BLACK%(asctime)s$RESET$COLOR[$ICON%(levelname)s]$RESET $BLACK%(message)s$RESET"
 
     def __init__(self):
         super().__init__()
 
     def format(self, record: LogRecord) -> str:
+        from colorama import Fore, Style
         # Get which color to use
-        color_to_use = ColorFormatter.COLORS[record.levelno]
+        color_to_use = getattr(Fore, ColorFormatter.COLORS[record.levelno])
         icon_to_use = ColorFormatter.ICONS[record.levelno]
         # Create the formatter
-        format = ColorFormatter.LOG_FORMAT.replace("$COLOR", color_to_use).replace("$ICON", icon_to_use)
+        format = ColorFormatter.LOG_FORMAT.replace("$BLACK", Fore.BLACK).replace("$RESET", Style.RESET_ALL)
+        format = format.replace("$COLOR", color_to_use).replace("$ICON", icon_to_use)
         formatter = Formatter(format)
         return formatter.format(record)
 
 def get_logger(name:str)->logging.Logger:
     """Gets and returns a logger for the current file.
-    Includes adding the color formatted logging handler."""
+    Includes adding the color formatted logging handler. Can be called multiple times for the same logger (for
+    example for each sync profile) without messages being printed more than once."""
     logger = getLogger(name)
+    # Every logger has its own handler, so messages should not also be handled by parent loggers (for example the
+    # sync logger for the logger of a sync profile)
+    logger.propagate = False
+    if len(logger.handlers) > 0: # (the handler has already been added)
+        return logger
     stream_handler = StreamHandler()
     # Set log level
     logger.setLevel(DEBUG)